@@ -0,0 +1,204 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import hashlib
+import os
+import numpy as np
+import scipy.sparse
+
+
+#-------------------------------------------------------------------------------
+
+def file_hash(path):
+    """ SHA-1 of the content of the file at the given path """
+    h = hashlib.sha1()
+    with open(path, 'rb') as in_file:
+        while True:
+            buf = in_file.read(1 << 20)
+            if not buf:
+                break
+            h.update(buf)
+    return h.hexdigest()
+
+
+#-------------------------------------------------------------------------------
+
+class AnnotationIndex(object):
+    """ Protein annotations parsed once. Functions (GO terms) are interned as
+        small ints (their position in functions) and the functions of every
+        protein are kept as sorted int arrays in CSR layout: the functions of
+        proteins[i] are indices[indptr[i] : indptr[i + 1]]. file_indices has
+        the same functions in the order they first appear in the file, which
+        fixes the iteration order of the sets read_in_annotations builds
+    """
+
+    def __init__(self, proteins, functions, indptr, indices, file_indices):
+        self.proteins = proteins
+        self.functions = functions
+        self.indptr = indptr
+        self.indices = indices
+        self.file_indices = file_indices
+        self.protein_to_row = dict((p, i) for i, p in enumerate(proteins))
+        self.function_to_id = dict((f, i) for i, f in enumerate(functions))
+
+
+    @classmethod
+    def parse(cls, annotation_file):
+        """ Parse the annotation file, the protein is in the second and the
+            function in the fourth tab-separated column """
+        protein_to_row = {}
+        function_to_id = {}
+        rows = []
+        with open(annotation_file, 'r') as in_file:
+            for line in in_file:
+                tokens = line.split('\t')
+                r = protein_to_row.setdefault(tokens[1], len(protein_to_row))
+                if r == len(rows):
+                    rows.append(([], set()))
+                f = function_to_id.setdefault(tokens[3], len(function_to_id))
+                if f not in rows[r][1]:
+                    rows[r][0].append(f)
+                    rows[r][1].add(f)
+
+        proteins = sorted(protein_to_row, key = protein_to_row.get)
+        functions = sorted(function_to_id, key = function_to_id.get)
+        indptr = np.zeros(len(rows) + 1, dtype = np.int64)
+        indptr[1:] = np.cumsum([len(r[0]) for r in rows])
+        indices = np.empty(indptr[-1], dtype = np.int32)
+        file_indices = np.empty(indptr[-1], dtype = np.int32)
+        for i, r in enumerate(rows):
+            indices[indptr[i] : indptr[i + 1]] = sorted(r[0])
+            file_indices[indptr[i] : indptr[i + 1]] = r[0]
+
+        return cls(proteins, functions, indptr, indices, file_indices)
+
+
+    @classmethod
+    def from_file(cls, annotation_file, cache_path = None):
+        """ Load the index of the annotation file from the binary cache at
+            cache_path (annotation_file + '.index.npz' by default). The cache is
+            rebuilt when the annotation file changed, which is checked with its
+            modification time and, if that differs, its hash. A cache whose hash
+            still matches is stamped with the new modification time, so the
+            file is hashed only once after it was touched. Caches without the
+            file order of the functions are rebuilt
+        """
+        if cache_path is None:
+            cache_path = '%s.index.npz' % annotation_file
+        mtime = os.path.getmtime(annotation_file)
+
+        if os.path.exists(cache_path):
+            with np.load(cache_path) as cache:
+                complete = 'file_indices' in cache.files
+                source_mtime = float(cache['source_mtime'])
+                source_hash = str(cache['source_hash'])
+            if complete and source_mtime == mtime:
+                return cls.load(cache_path)
+            if complete and source_hash == file_hash(annotation_file):
+                index = cls.load(cache_path)
+                index.save(cache_path, annotation_file, source_hash)
+                return index
+
+        index = cls.parse(annotation_file)
+        index.save(cache_path, annotation_file)
+        return index
+
+
+    @classmethod
+    def load(cls, cache_path):
+        """ Load the index saved at cache_path, without checking it against
+            the annotation file. Indexes saved without the file order of the
+            functions get the sorted one """
+        with np.load(cache_path) as cache:
+            file_indices = cache['file_indices'] if 'file_indices' in cache.files \
+                           else cache['indices']
+            return cls(cache['proteins'].tolist(), cache['functions'].tolist(), \
+                       cache['indptr'], cache['indices'], file_indices)
+
+
+    def save(self, cache_path, annotation_file, source_hash = None):
+        """ Save the index at cache_path, stamped with the modification time
+            and the hash of the annotation file it was built from (source_hash,
+            if it is already known) """
+        if source_hash is None:
+            source_hash = file_hash(annotation_file)
+        with open(cache_path, 'wb') as out:
+            np.savez(out, proteins = np.array(self.proteins, dtype = str), \
+                     functions = np.array(self.functions, dtype = str), \
+                     indptr = self.indptr, indices = self.indices, \
+                     file_indices = self.file_indices, \
+                     source_mtime = os.path.getmtime(annotation_file), \
+                     source_hash = source_hash)
+
+
+    def functions_of_row(self, r):
+        """ Sorted array of function ids of proteins[r] """
+        return self.indices[self.indptr[r] : self.indptr[r + 1]]
+
+
+    def functions_of(self, protein):
+        """ Sorted array of function ids of the protein (empty if the protein
+            is not annotated) """
+        r = self.protein_to_row.get(protein)
+        if r is None:
+            return self.indices[:0]
+        return self.functions_of_row(r)
+
+
+    def function_set(self, r):
+        """ Set of the function names of proteins[r], built in file order like
+            the original read_in_annotations did, so that it iterates in the
+            same order """
+        functions = set()
+        for f in self.file_indices[self.indptr[r] : self.indptr[r + 1]].tolist():
+            functions.add(self.functions[f])
+        return functions
+
+
+    def set_order_row(self, r):
+        """ Function ids of proteins[r] in the iteration order of its
+            function_set """
+        return np.array([self.function_to_id[f] for f in self.function_set(r)], \
+                        dtype = self.indices.dtype)
+
+
+    def protein_to_functions(self):
+        """ Protein to set of functions dictionary, as read_in_annotations
+            returns it """
+        return dict((p, self.function_set(r)) for r, p in enumerate(self.proteins))
+
+
+    def matrix(self, nodes, id_to_protein, set_order = False):
+        """ Binary nodes x functions matrix in CSR format where the row of every
+            node of the graph marks the functions of its protein. Columns are
+            the function ids of the index. With set_order the functions of
+            every row are in the iteration order of the set of the protein
+            (see set_order_row) instead of sorted, which is the order
+            semantic() sums over
+        """
+        rows = np.empty(nodes, dtype = np.int64)
+        rows.fill(-1)
+        for node in xrange(nodes):
+            rows[node] = self.protein_to_row.get(id_to_protein.get(node), -1)
+
+        found = rows >= 0
+        counts = np.zeros(nodes, dtype = np.int64)
+        counts[found] = self.indptr[rows[found] + 1] - self.indptr[rows[found]]
+        indptr = np.zeros(nodes + 1, dtype = np.int64)
+        indptr[1:] = np.cumsum(counts)
+
+        row_functions = self.set_order_row if set_order else self.functions_of_row
+        indices = np.concatenate([self.indices[:0]] + \
+                                 [row_functions(r) for r in rows[found].tolist()])
+        return scipy.sparse.csr_matrix((np.ones(len(indices)), indices, indptr), \
+                                       shape = (nodes, len(self.functions)))
+
+
+#-------------------------------------------------------------------------------
+
+def annotation_index(annotations):
+    """ Return annotations if it is already an AnnotationIndex, otherwise load
+        the (cached) index of the annotation file at that path """
+    if isinstance(annotations, AnnotationIndex):
+        return annotations
+    return AnnotationIndex.from_file(annotations)
@@ -2,6 +2,16 @@
 # -*- coding: utf-8 -*-
 
 import community
+import multiprocessing
+import os
+import shutil
+import tempfile
+import networkx as nx
+import numpy as np
+import scipy.sparse
+import scipy.stats
+from csr_store import save_csr_matrix, load_csr_matrix
+from annotation_index import annotation_index
 
 
 #-------------------------------------------------------------------------------
@@ -39,4 +49,392 @@ def louvain (graph):
 def louvain_best(graph):
     """ Lovain clustering, returns only the best clustering """
     partition = community.best_partition(graph)
-    return {0: to_clusters_dict (partition)}
\ No newline at end of file
+    return {0: to_clusters_dict (partition)}
+
+
+#-------------------------------------------------------------------------------
+
+def sparse_adjacency (graph):
+    """ Symmetric weighted adjacency matrix of the graph in CSR format and the
+        labels of its rows. graph is a networkx graph, a CachedGraph or
+        already a sparse matrix (whose rows are labeled 0..N-1) """
+    if scipy.sparse.issparse(graph):
+        A = graph
+        labels = np.arange(A.shape[0])
+    elif hasattr(graph, 'adjacency'):
+        A = graph.adjacency()
+        labels = np.arange(A.shape[0])
+    else:
+        labels = np.array(graph.nodes())
+        A = nx.to_scipy_sparse_matrix(graph, nodelist = labels.tolist(), format = 'csr')
+    A = scipy.sparse.csr_matrix(A, dtype = np.float64)
+    A.sort_indices()
+    return A, labels
+
+
+def sparse_modularity (A, loops, degrees, partition):
+    """ Modularity of the partition (community of every row) of the graph with
+        the symmetric adjacency matrix A, its self loops and weighted degrees
+        (self loops counted twice, as networkx counts them) """
+    m2 = degrees.sum()
+    if m2 == 0:
+        return 0.0
+    A = A.tocoo()
+    inside = A.data[partition[A.row] == partition[A.col]].sum()
+    # every edge is in A twice, self loops once
+    internal = (inside + loops.sum()) * 0.5
+    tot = np.bincount(partition, weights = degrees)
+    return internal / (m2 * 0.5) - ((tot / m2) ** 2).sum()
+
+
+def sparse_one_level (A, loops, degrees, min_increase, random_state = None):
+    """ One level of louvain clustering over the CSR matrix A: nodes are moved
+        to the neighbouring community with the largest modularity gain until
+        a pass over all the nodes improves the modularity by less than
+        min_increase. The gains of all the neighbouring communities of a node
+        are computed at once. Nodes are visited in order, or in a random order
+        drawn from the numpy RandomState random_state. Returns the community
+        of every node and the modularity
+    """
+    n = A.shape[0]
+    m2 = degrees.sum()
+    indptr, indices, data = A.indptr, A.indices, A.data
+    com = np.arange(n)
+    tot = degrees.copy()
+    modularity = sparse_modularity(A, loops, degrees, com)
+
+    while True:
+        moved = False
+        order = xrange(n) if random_state is None else random_state.permutation(n)
+        for u in order:
+            start, end = indptr[u], indptr[u + 1]
+            neighbours = indices[start : end]
+            not_loop = neighbours != u
+            coms, inverse = np.unique(com[neighbours[not_loop]], return_inverse = True)
+            links = np.bincount(inverse, weights = data[start : end][not_loop])
+
+            old = com[u]
+            ku = degrees[u]
+            tot[old] -= ku
+            gains = links - tot[coms] * (ku / m2)
+            stay = coms == old
+            best = old
+            if len(coms):
+                k = gains.argmax()
+                own_gain = gains[stay][0] if stay.any() else - tot[old] * (ku / m2)
+                if gains[k] > own_gain:
+                    best = coms[k]
+            com[u] = best
+            tot[best] += ku
+            moved = moved or best != old
+
+        new_modularity = sparse_modularity(A, loops, degrees, com)
+        increase = new_modularity - modularity
+        modularity = new_modularity
+        if not moved or increase < min_increase:
+            break
+
+    return com, modularity
+
+
+def sparse_renumber (partition):
+    """ Renumber the communities 0..C-1 in order of first appearance """
+    _, first, inverse = np.unique(partition, return_index = True, return_inverse = True)
+    rank = np.empty(len(first), dtype = np.int64)
+    rank[np.argsort(first)] = np.arange(len(first))
+    return rank[inverse]
+
+
+def sparse_induced_graph (A, loops, partition):
+    """ Graph of the communities of the partition, as induced_graph of the
+        community package builds it: the weight between two communities is
+        the sum of the weights between their nodes and every community gets
+        a self loop with its internal weight. Returns the CSR matrix and its
+        self loops
+    """
+    n = A.shape[0]
+    C = scipy.sparse.csr_matrix((np.ones(n), (np.arange(n), partition)), \
+                                shape = (n, partition.max() + 1))
+    B = C.transpose().dot(A).dot(C).tocsr()
+    # the diagonal holds every internal edge twice and every self loop once
+    new_loops = (B.diagonal() + np.bincount(partition, weights = loops, \
+                                            minlength = B.shape[0])) * 0.5
+    B = B - scipy.sparse.diags(B.diagonal()) + scipy.sparse.diags(new_loops)
+    B = scipy.sparse.csr_matrix(B)
+    B.eliminate_zeros()
+    B.sort_indices()
+    return B, new_loops
+
+
+def sparse_dendrogram (A, min_increase = 1e-12, random_state = None):
+    """ generate_dendrogram of the community package over the symmetric CSR
+        matrix A: list of partitions (arrays with the community of every
+        node of the level below), together with the modularity of every level
+    """
+    loops = A.diagonal().astype(np.float64)
+    degrees = np.asarray(A.sum(axis = 1)).ravel() + loops
+    if A.nnz == 0:
+        return [np.arange(A.shape[0])], [0.0]
+
+    dendrogram = []
+    modularities = []
+    mod = None
+    while True:
+        com, new_mod = sparse_one_level(A, loops, degrees, min_increase, random_state)
+        if mod is not None and new_mod - mod < min_increase:
+            break
+        com = sparse_renumber(com)
+        dendrogram.append(com)
+        modularities.append(new_mod)
+        mod = new_mod
+        A, loops = sparse_induced_graph(A, loops, com)
+        degrees = np.asarray(A.sum(axis = 1)).ravel() + loops
+
+    return dendrogram, modularities
+
+
+def sparse_partition_at_level (dendrogram, level):
+    """ Community of every node of the graph at the given level """
+    partition = dendrogram[0]
+    for index in xrange(1, level + 1):
+        partition = dendrogram[index][partition]
+    return partition
+
+
+def array_to_clusters_dict (partition, labels):
+    """ to_clusters_dict for the partition given as the array of communities
+        of the nodes labeled by labels """
+    clusters = {}
+    for node, cluster in zip(labels.tolist(), partition.tolist()):
+        clusters.setdefault(cluster, set()).add(node)
+    return clusters
+
+
+def louvain_sparse (graph, min_increase = 1e-12, random_state = None):
+    """ Louvain clustering over the CSR arrays of the graph (see
+        sparse_adjacency), with array based community aggregation. Returns
+        the same levels louvain does, as {level: {cluster: set(nodes)}}.
+        random_state seeds the order in which the nodes are visited, by
+        default they are visited in order
+    """
+    A, labels = sparse_adjacency(graph)
+    if random_state is not None:
+        random_state = np.random.RandomState(random_state)
+    dendrogram, _ = sparse_dendrogram(A, min_increase, random_state)
+
+    multilevel = {}
+    for level in range(len(dendrogram) - 1):
+        partition = sparse_partition_at_level(dendrogram, level)
+        multilevel[level] = array_to_clusters_dict(partition, labels)
+
+    return multilevel
+
+
+#-------------------------------------------------------------------------------
+
+def louvain_run (args):
+    """ Worker of louvain_ensemble. Loads the shared (memory-mapped) matrix and
+        returns (seed, partition, modularity) of the last level of a louvain
+        run with the nodes visited in the order drawn from seed """
+    matrix_path, seed, min_increase = args
+    A = load_csr_matrix(matrix_path)
+    dendrogram, modularities = sparse_dendrogram(A, min_increase, \
+                                                 np.random.RandomState(seed))
+    return seed, sparse_partition_at_level(dendrogram, len(dendrogram) - 1), \
+           modularities[-1]
+
+
+def co_assignment_matrix (A, partitions):
+    """ Sparse matrix with the pattern of A (without self loops) holding, for
+        every edge, the fraction of the partitions that put both of its nodes
+        in the same community """
+    A = scipy.sparse.csr_matrix(A)
+    rows = np.repeat(np.arange(A.shape[0]), np.diff(A.indptr))
+    cols = A.indices
+    together = np.zeros(len(cols))
+    for partition in partitions:
+        together += partition[rows] == partition[cols]
+    together[rows == cols] = 0
+
+    C = scipy.sparse.csr_matrix((together / len(partitions), cols, A.indptr), \
+                                shape = A.shape)
+    C.eliminate_zeros()
+    return C
+
+
+def louvain_ensemble (graph, runs = 10, processes = None, threshold = 0.5, \
+                      min_increase = 1e-12, seed = 0):
+    """ Stable louvain clustering: runs louvain (louvain_sparse) runs times
+        with the nodes visited in different random orders (seeds seed,
+        seed + 1, ...) on a pool of processes (cpu_count() by default) that
+        share the adjacency matrix through memory-mapped files. The final
+        partitions of the runs are combined in the co-assignment matrix over
+        the edges of the graph (see co_assignment_matrix), its entries below
+        threshold are dropped and louvain is run on it once more for the
+        consensus. Returns ({0: clusters}, modularities) where the clusters
+        are as louvain_best returns them and modularities holds the
+        modularity of every run on the graph, in seed order
+    """
+    A, labels = sparse_adjacency(graph)
+
+    tmp_dir = tempfile.mkdtemp(prefix = 'louvain_')
+    try:
+        matrix_path = os.path.join(tmp_dir, 'adjacency')
+        save_csr_matrix(A, matrix_path)
+        tasks = [(matrix_path, seed + r, min_increase) for r in xrange(runs)]
+
+        results = {}
+        pool = multiprocessing.Pool(processes)
+        try:
+            for run_seed, partition, modularity in pool.imap_unordered(louvain_run, tasks):
+                results[run_seed] = (partition, modularity)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    seeds = sorted(results)
+    C = co_assignment_matrix(A, [results[s][0] for s in seeds])
+    C.data[C.data < threshold] = 0
+    C.eliminate_zeros()
+
+    dendrogram, _ = sparse_dendrogram(C, min_increase)
+    consensus = sparse_partition_at_level(dendrogram, len(dendrogram) - 1)
+    return {0: array_to_clusters_dict(consensus, labels)}, \
+           [results[s][1] for s in seeds]
+
+
+#-------------------------------------------------------------------------------
+
+def cluster_matrix (clusters, nodes):
+    """ Sparse nodes x clusters binary matrix of the clusters as to_clusters_dict
+        returns them (nodes are 0..nodes-1, a node in no cluster has an empty
+        row) """
+    members = [(node, c) for c, cluster in enumerate(clusters.values()) for node in cluster]
+    rows = np.array([m[0] for m in members], dtype = np.int64)
+    cols = np.array([m[1] for m in members], dtype = np.int64)
+    return scipy.sparse.csr_matrix((np.ones(len(members)), (rows, cols)), \
+                                   shape = (nodes, len(clusters)))
+
+
+def cluster_term_scores (clusters, M, leave_one_out = True):
+    """ Enrichment scores of the functions in the clusters of the nodes: the
+        score of function t for node i is -log10 of the hypergeometric
+        probability of seeing at least as many proteins annotated with t among
+        the annotated proteins of the cluster of i, the annotated nodes of the
+        graph being the population. M is the binary node x function matrix
+        (see AnnotationIndex.matrix). The counts come from the sparse cluster x
+        function matrix. With leave_one_out the node itself is left out of
+        its cluster and of the population, for all the nodes at once, so the
+        scores can be checked against its own annotations. Returns the sparse
+        node x function matrix of the scores of the functions that appear in
+        the (rest of the) cluster, every such function has an explicit entry
+        even where its score is 0
+    """
+    N = M.shape[0]
+    M = scipy.sparse.csr_matrix(M)
+    C = cluster_matrix(clusters, N)
+    annotated = (np.diff(M.indptr) > 0).astype(np.float64)
+
+    # the counts of the cluster of every node
+    K = C.transpose().dot(M)
+    P = C.dot(K).tocsr()
+    draws = C.dot(C.transpose().dot(annotated))
+    totals = np.asarray(M.sum(axis = 0)).ravel()
+    population = annotated.sum()
+
+    if leave_one_out:
+        clustered = (np.diff(C.indptr) > 0).astype(np.float64)
+        P = (P - scipy.sparse.diags(clustered).dot(M)).tocsr()
+        draws = draws - annotated * clustered
+    P.eliminate_zeros()
+    P = P.tocoo()
+
+    k = P.data
+    n = totals[P.col]
+    pop = np.repeat(population, len(k))
+    if leave_one_out:
+        own = np.asarray(M[P.row, P.col], dtype = np.float64).ravel()
+        n = n - own
+        pop = pop - annotated[P.row]
+    scores = - scipy.stats.hypergeom.logsf(k - 1, pop, n, draws[P.row]) / np.log(10)
+
+    return scipy.sparse.csr_matrix((scores, (P.row, P.col)), shape = M.shape)
+
+
+def predict_functions (clusters, id_to_protein, annotations, nodes, top = 10):
+    """ Predict the functions of the proteins from the clusters of their nodes:
+        returns a protein to list of (function, score) dictionary with the
+        top best scoring functions (see cluster_term_scores) of every
+        protein """
+    index = annotation_index(annotations)
+    scores = cluster_term_scores(clusters, index.matrix(nodes, id_to_protein), False)
+
+    predictions = {}
+    for node in xrange(nodes):
+        row = scores[node]
+        best = np.argsort(-row.data, kind = 'mergesort')[:top]
+        if node in id_to_protein and len(best):
+            predictions[id_to_protein[node]] = [(index.functions[f], s) for f, s in \
+                                                zip(row.indices[best].tolist(), row.data[best].tolist())]
+    return predictions
+
+
+#-------------------------------------------------------------------------------
+
+def precision_recall (scores, M):
+    """ Precision/recall curve of the scores (sparse node x function matrix)
+        against the annotations M, over the (node, function) predictions of
+        the annotated nodes ranked by score; the unannotated nodes cannot be
+        checked and are left out. Recall is relative to all the annotations
+        in M, so curves of different clusterings of the same nodes share the
+        denominator. Returns (thresholds, precision, recall) arrays with a
+        point for every distinct score
+    """
+    M = scipy.sparse.csr_matrix(M)
+    scores = scipy.sparse.csr_matrix(scores).tocoo()
+    annotated = np.diff(M.indptr) > 0
+    # explicit zero scores are predictions too
+    keep = annotated[scores.row]
+    rows, cols, values = scores.row[keep], scores.col[keep], scores.data[keep]
+    correct = np.asarray(M[rows, cols]).ravel() > 0 \
+              if len(rows) else np.zeros(0, dtype = bool)
+    relevant = M.nnz
+
+    order = np.argsort(-values, kind = 'mergesort')
+    thresholds = values[order]
+    tp = np.cumsum(correct[order])
+    count = np.arange(1, len(order) + 1)
+
+    # last prediction of every distinct score
+    last = np.r_[thresholds[1:] != thresholds[:-1], True] if len(order) else \
+           np.zeros(0, dtype = bool)
+    precision = tp[last] / count[last].astype(np.float64)
+    recall = tp[last] / float(max(relevant, 1))
+    return thresholds[last], precision, recall
+
+
+def compare_predictions (clusterings, id_to_protein, annotations, nodes):
+    """ Leave-one-out benchmark of the cluster based function prediction for
+        several graphs side by side. clusterings maps the name of every graph
+        (e.g. 'jaccard', 'resnik', 'wang', 'rw') to its clusters as
+        to_clusters_dict returns them. Returns a name to dictionary with the
+        precision/recall curve ('thresholds', 'precision', 'recall', see
+        precision_recall), the area under it ('aupr') and the best F1 ('f1')
+    """
+    M = annotation_index(annotations).matrix(nodes, id_to_protein)
+
+    results = {}
+    for name in sorted(clusterings):
+        thresholds, precision, recall = \
+            precision_recall(cluster_term_scores(clusterings[name], M), M)
+        f1 = 2 * precision * recall / np.maximum(precision + recall, 1e-12)
+        results[name] = {'thresholds': thresholds, 'precision': precision, \
+                         'recall': recall, \
+                         'aupr': float(np.trapz(precision, recall)) if len(recall) else 0.0, \
+                         'f1': float(f1.max()) if len(f1) else 0.0}
+    return results
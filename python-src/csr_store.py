@@ -0,0 +1,36 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import os
+import numpy as np
+import scipy.sparse
+
+
+# Square CSR matrices saved as a directory with the data.npy, indices.npy and
+# indptr.npy arrays, which other processes memory-map instead of copying
+
+
+#-------------------------------------------------------------------------------
+
+def save_csr_matrix(M, path):
+    """ Save the square CSR matrix M as .npy files in the directory at the given
+        path, so that other processes can memory-map it with load_csr_matrix
+    """
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    np.save(os.path.join(path, 'data.npy'), M.data)
+    np.save(os.path.join(path, 'indices.npy'), M.indices)
+    np.save(os.path.join(path, 'indptr.npy'), M.indptr)
+
+
+def load_csr_matrix(path, mmap_mode = 'r'):
+    """ Load the matrix saved with save_csr_matrix. The arrays are memory-mapped
+        (read-only by default) and shared between all processes that load the
+        same path
+    """
+    data = np.load(os.path.join(path, 'data.npy'), mmap_mode = mmap_mode)
+    indices = np.load(os.path.join(path, 'indices.npy'), mmap_mode = mmap_mode)
+    indptr = np.load(os.path.join(path, 'indptr.npy'), mmap_mode = mmap_mode)
+
+    N = len(indptr) - 1
+    return scipy.sparse.csr_matrix((data, indices, indptr), shape = (N, N), copy = False)
@@ -0,0 +1,124 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import struct
+import numpy as np
+
+
+# Shortest path distances of all node pairs (i, j), i < j, of a graph with N
+# nodes, stored as the upper triangle of the distance matrix, row by row, one
+# uint8 per pair (0 when there is no path). The data is preceded by a 24 bytes
+# header: 'DIST', format version, N and the diameter of the graph.
+DISTANCE_MAGIC = 'DIST'
+DISTANCE_VERSION = 1
+DISTANCE_HEADER = struct.Struct('<4sIQII')
+NO_PATH = 0
+
+
+#-------------------------------------------------------------------------------
+
+def pairs_count(nodes):
+    """ Number of pairs stored for a graph with the given number of nodes """
+    return nodes * (nodes - 1) // 2
+
+
+def row_offset(nodes, i):
+    """ Position of the pair (i, i + 1) in the data of the store (i can be an
+        array of rows) """
+    return i * (nodes - 1) - i * (i - 1) // 2
+
+
+#-------------------------------------------------------------------------------
+
+def read_distance_header(path):
+    """ Returns (N, diameter) from the header of the store """
+    with open(path, 'rb') as in_file:
+        header = in_file.read(DISTANCE_HEADER.size)
+        magic, version, nodes, diameter, _ = DISTANCE_HEADER.unpack(header)
+    if magic != DISTANCE_MAGIC or version != DISTANCE_VERSION:
+        raise ValueError('%s is not a distance store' % path)
+    return nodes, diameter
+
+
+def write_distance_header(path, nodes, diameter):
+    """ Write the header of the store """
+    with open(path, 'r+b') as out:
+        out.write(DISTANCE_HEADER.pack(DISTANCE_MAGIC, DISTANCE_VERSION, nodes, \
+                                       diameter, 0))
+
+
+def create_distance_store(path, nodes):
+    """ Create the store for a graph with the given number of nodes, with all
+        pairs set to NO_PATH and the diameter to 0 """
+    with open(path, 'wb') as out:
+        out.write(DISTANCE_HEADER.pack(DISTANCE_MAGIC, DISTANCE_VERSION, nodes, 0, 0))
+        out.truncate(DISTANCE_HEADER.size + pairs_count(nodes))
+
+
+def open_distance_store(path, mode = 'r'):
+    """ Memory-map the store. Returns (N, diameter, data) where data is the
+        flat uint8 upper triangle """
+    nodes, diameter = read_distance_header(path)
+    if pairs_count(nodes) == 0:
+        return nodes, diameter, np.zeros(0, dtype = np.uint8)
+    data = np.memmap(path, dtype = np.uint8, mode = mode, \
+                     offset = DISTANCE_HEADER.size, shape = (pairs_count(nodes),))
+    return nodes, diameter, data
+
+
+def write_distance_row(data, nodes, i, row, unreachable = 255):
+    """ Store the distances from node i to the nodes j > i, row is the full
+        row of distances from i where unreachable marks the missing paths """
+    d = np.array(row[i + 1:], dtype = np.uint8)
+    d[d == unreachable] = NO_PATH
+    start = row_offset(nodes, i)
+    data[start : start + len(d)] = d
+
+
+#-------------------------------------------------------------------------------
+
+def iter_distance_blocks(path, block_size = 1 << 24):
+    """ Yield (nodes1, nodes2, distances) arrays of all the connected pairs, in
+        (nodes1, nodes2) order, reading about block_size pairs at a time """
+    nodes, diameter, data = open_distance_store(path)
+    offsets = row_offset(nodes, np.arange(nodes, dtype = np.int64))
+
+    for start in xrange(0, len(data), block_size):
+        d = np.asarray(data[start : start + block_size])
+        positions = np.nonzero(d)[0]
+        flat = positions + start
+        nodes1 = np.searchsorted(offsets, flat, side = 'right') - 1
+        nodes2 = flat - offsets[nodes1] + nodes1 + 1
+        yield nodes1, nodes2, d[positions]
+
+
+def distance_histogram(path, block_size = 1 << 24):
+    """ Number of pairs for every distance 0..diameter, where pairs without a
+        path are counted at 0 """
+    nodes, diameter, data = open_distance_store(path)
+    counts = np.zeros(max(diameter, 1) + 1, dtype = np.int64)
+    for start in xrange(0, len(data), block_size):
+        block = np.bincount(data[start : start + block_size], minlength = len(counts))
+        counts[:len(block)] += block[:len(counts)]
+    return counts
+
+
+def store_diameter(path):
+    """ Diameter of the graph as recorded in the header of the store """
+    return read_distance_header(path)[1]
+
+
+def max_stored_distance(path, block_size = 1 << 24):
+    """ Scan the data of the store for its largest distance """
+    nodes, diameter, data = open_distance_store(path)
+    diameter = 0
+    for start in xrange(0, len(data), block_size):
+        diameter = max(diameter, int(data[start : start + block_size].max()))
+    return diameter
+
+
+def iter_pairs_at_distance(path, k, block_size = 1 << 24):
+    """ Yield (nodes1, nodes2) arrays of the pairs at distance k """
+    for nodes1, nodes2, d in iter_distance_blocks(path, block_size):
+        at_k = d == k
+        yield nodes1[at_k], nodes2[at_k]
@@ -0,0 +1,166 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import os
+import struct
+import numpy as np
+
+
+# Binary edgelist: a 12 bytes header ('EDGL', format version, number of
+# columns) followed by (int32 node, int32 node[, float64 weight]) records
+EDGELIST_MAGIC = 'EDGL'
+EDGELIST_VERSION = 1
+EDGELIST_HEADER = struct.Struct('<4sII')
+
+
+#-------------------------------------------------------------------------------
+
+def edgelist_record_dtype (columns):
+    """ numpy dtype of the records of a binary edgelist """
+    fields = [('node1', '<i4'), ('node2', '<i4')]
+    if columns > 2:
+        fields.append(('weight', '<f8'))
+    return np.dtype(fields)
+
+
+def is_binary_edgelist (path):
+    """ Check whether the file at the given path is a binary edgelist """
+    with open(path, 'rb') as in_file:
+        return in_file.read(len(EDGELIST_MAGIC)) == EDGELIST_MAGIC
+
+
+def iter_binary_edgelist_chunks (path, chunk_size = 1 << 24, \
+                                 weight_dtype = np.float64):
+    """ iter_edgelist_chunks for binary edgelists """
+    with open(path, 'rb') as in_file:
+        header = in_file.read(EDGELIST_HEADER.size)
+        magic, version, columns = EDGELIST_HEADER.unpack(header)
+        if magic != EDGELIST_MAGIC or version != EDGELIST_VERSION:
+            raise ValueError('%s is not a binary edgelist' % path)
+
+        dtype = edgelist_record_dtype(columns)
+        while True:
+            records = np.fromfile(in_file, dtype = dtype, \
+                                  count = max(1, chunk_size // dtype.itemsize))
+            if not len(records):
+                break
+            weights = records['weight'].astype(weight_dtype) if columns > 2 else None
+            yield records['node1'], records['node2'], weights
+
+
+#-------------------------------------------------------------------------------
+
+def iter_edgelist_chunks (path, chunk_size = 1 << 24, with_lines = False, \
+                          weight_dtype = np.float64):
+    """ Read the file in edgelist format, 'nodeID nodeID [weight]' lines, in
+        chunks of about chunk_size bytes. Every chunk is parsed with a single
+        numpy call and yielded as (nodes1, nodes2, weights) arrays, where nodes
+        are int32 and weights is None for files without the weight column.
+        If with_lines is set the raw lines of the chunk are yielded as well,
+        as the fourth element. All lines must have the same number of columns.
+        Binary edgelists (see save_edgelist) are read as well
+    """
+    if is_binary_edgelist(path):
+        if with_lines:
+            raise ValueError('%s is a binary edgelist, it has no lines' % path)
+        for chunk in iter_binary_edgelist_chunks(path, chunk_size, weight_dtype):
+            yield chunk
+        return
+
+    with open(path, 'r') as in_file:
+        columns = None
+        while True:
+            lines = in_file.readlines(chunk_size)
+            if not lines:
+                break
+
+            if columns is None:
+                columns = len(lines[0].split())
+            data = np.fromstring(''.join(lines), sep = ' ')
+            if len(data) != columns * len(lines):
+                raise ValueError('%s: every line must have %d columns' % (path, columns))
+            data = data.reshape(-1, columns)
+
+            nodes1 = data[:, 0].astype(np.int32)
+            nodes2 = data[:, 1].astype(np.int32)
+            weights = data[:, 2].astype(weight_dtype) if columns > 2 else None
+            if with_lines:
+                yield nodes1, nodes2, weights, lines
+            else:
+                yield nodes1, nodes2, weights
+
+
+#-------------------------------------------------------------------------------
+
+def write_edgelist (out, nodes1, nodes2, weights = None, chunk_size = 1 << 16, \
+                    line = None):
+    """ Write the edges given as (nodes1, nodes2[, weights]) arrays to the
+        opened out file as 'node node weight' lines ('%d %d %f') or 'node node'
+        lines if weights is None. line overrides the format of a line. Lines
+        are formatted chunk_size at a time with a single string formatting
+        operation
+    """
+    columns = [nodes1, nodes2] if weights is None else [nodes1, nodes2, weights]
+    if line is None:
+        line = '%d %d\n' if weights is None else '%d %d %f\n'
+
+    write_columns(out, columns, line, chunk_size)
+
+
+def write_columns (out, columns, line, chunk_size = 1 << 16):
+    """ Write the aligned arrays in columns to the opened out file, one line
+        with format line per row, chunk_size rows at a time """
+    for start in xrange(0, len(columns[0]), chunk_size):
+        values = [np.asarray(c[start : start + chunk_size]).tolist() for c in columns]
+        flat = [None] * (len(values[0]) * len(columns))
+        for k, v in enumerate(values):
+            flat[k::len(columns)] = v
+        out.write((line * len(values[0])) % tuple(flat))
+
+
+def save_edgelist (path, nodes1, nodes2, weights = None, binary = False, mode = 'w'):
+    """ Save the edges given as (nodes1, nodes2[, weights]) arrays at the given
+        path as text (see write_edgelist) or, if binary is set, as a binary
+        edgelist. mode 'a' appends to the existing file
+    """
+    if not binary:
+        with open(path, mode) as out:
+            write_edgelist(out, nodes1, nodes2, weights)
+        return
+
+    columns = 2 if weights is None else 3
+    records = np.empty(len(nodes1), dtype = edgelist_record_dtype(columns))
+    records['node1'] = nodes1
+    records['node2'] = nodes2
+    if weights is not None:
+        records['weight'] = weights
+
+    new_file = mode == 'w' or not os.path.exists(path)
+    if not new_file:
+        with open(path, 'rb') as in_file:
+            header = in_file.read(EDGELIST_HEADER.size)
+            if EDGELIST_HEADER.unpack(header)[2] != columns:
+                raise ValueError('%s has a different number of columns' % path)
+    with open(path, 'wb' if new_file else 'ab') as out:
+        if new_file:
+            out.write(EDGELIST_HEADER.pack(EDGELIST_MAGIC, EDGELIST_VERSION, columns))
+        records.tofile(out)
+
+
+#-------------------------------------------------------------------------------
+
+def edge_keys (edges, directed = False):
+    """ Sorted int64 keys of the (node1, node2) edges, to be matched with
+        has_edges. Both directions are added unless directed is set """
+    E = np.array(edges, dtype = np.int64).reshape(-1, 2)
+    keys = (E[:, 0] << 32) | E[:, 1]
+    if not directed:
+        keys = np.concatenate((keys, (E[:, 1] << 32) | E[:, 0]))
+    return np.unique(keys)
+
+
+def has_edges (keys, nodes1, nodes2):
+    """ Vectorized has_edge: boolean mask of the (nodes1, nodes2) pairs whose
+        key is in keys (as returned by edge_keys) """
+    pairs = (nodes1.astype(np.int64) << 32) | nodes2.astype(np.int64)
+    return np.in1d(pairs, keys)
@@ -2,21 +2,28 @@
 # -*- coding: utf-8 -*-
 
 import networkx as nx
+import numpy as np
 import scipy.io
 import itertools
+import multiprocessing
+import os
+import shutil
 import sys
+import tempfile
 from graph_utility import *
 from interaction_graph_builder import *
+from edgelist_io import *
+from proximity_store import *
+from graph_diff import *
 
 
 #-------------------------------------------------------------------------------
 
-def save_matrix_to_edgelist(M, path):
-    """ Save the matrix M as edgelist at the given path """
+def save_matrix_to_edgelist(M, path, binary = False):
+    """ Save the matrix M as edgelist at the given path (as binary edgelist if
+        binary is set) """
     tmp = M.tocoo()
-    with open(path, 'w') as out:
-        for i, j, w in itertools.izip(tmp.row, tmp.col, tmp.data):
-            out.write('%d %d %f\n' % (i, j, w))
+    save_edgelist(path, tmp.row, tmp.col, tmp.data, binary)
 
 
 #-------------------------------------------------------------------------------
@@ -63,19 +70,31 @@ def semantic(set1, set2, functions_to_similarity):
 
 #-------------------------------------------------------------------------------
 
-def graph_content_jaccard(graph, id_to_protein, annotation_file, path):
+def jaccard_weights(M, nodes1, nodes2):
+    """ Vectorized jaccard for all the pairs of nodes in (nodes1, nodes2) arrays,
+        where M is the binary node x function matrix (see AnnotationIndex.matrix).
+        Pairs with a node without annotations get 0.0
+    """
+    intersect = np.asarray(M[nodes1].multiply(M[nodes2]).sum(axis = 1)).ravel()
+    sizes = np.diff(M.indptr)
+    size1 = sizes[nodes1].astype(np.float64)
+    size2 = sizes[nodes2].astype(np.float64)
+
+    J = np.zeros(len(intersect))
+    annotated = (size1 > 0) & (size2 > 0)
+    J[annotated] = (intersect[annotated] / size1[annotated] + \
+                    intersect[annotated] / size2[annotated]) * 0.5
+    return J
+
+
+def graph_content_jaccard(graph, id_to_protein, annotations, path, binary = False):
     """ Builds interaction graph with content based weighs using Jaccard
-        similarity metric, and save it at the given path """
-    protein_to_functions = read_in_annotations(annotation_file)
-    with open(path, 'w') as out:
-        for e in graph.edges_iter():
-            terms1 = protein_to_functions.get(id_to_protein[e[0]], None)
-            terms2 = protein_to_functions.get(id_to_protein[e[1]], None)
-            if terms1 and terms2:
-                J = jaccard(terms1, terms2)
-                out.write('%d %d %f\n' % (e[0], e[1], J))
-            else:
-                out.write('%d %d %f\n' % (e[0], e[1], 0.0))
+        similarity metric, and save it at the given path (as binary edgelist
+        if binary is set). annotations is the path of the annotation file or
+        its AnnotationIndex """
+    n1, n2, J = content_weights(graph, id_to_protein, annotations, 'jaccard')
+
+    save_edgelist(path, n1, n2, J, binary)
 
 
 #-------------------------------------------------------------------------------
@@ -95,72 +114,513 @@ def read_in_semantic_sim_file (path):
     return functions_to_similarity
 
 
-def graph_content_semantic(graph, id_to_protein, annotation_file, semantic_sim_file, path):
+def read_in_semantic_sim_matrix (path, functions):
+    """ Read in the semantic similarity file with format
+        'function function similarity' in a dense symmetric matrix whose rows
+        and columns follow the given list of functions. Pairs of functions
+        that are not in the list are skipped, missing pairs get 0. Pass only
+        the functions actually used (see used_functions), the matrix is
+        len(functions)^2 """
+    function_to_id = dict((f, i) for i, f in enumerate(functions))
+    S = np.zeros((len(functions), len(functions)))
+    with open(path, 'r') as in_file:
+        for line in in_file:
+            tokens = line.split()
+            if tokens[2] != 'NA' and tokens[0] in function_to_id and \
+                    tokens[1] in function_to_id:
+                i = function_to_id[tokens[0]]
+                j = function_to_id[tokens[1]]
+                S[i, j] = S[j, i] = float(tokens[2])
+
+    return S
+
+
+def used_functions(M):
+    """ The sorted ids of the functions used by the rows of the node x
+        function matrix M, and M with its columns renumbered 0..len(used)-1
+        in that order, so that a similarity matrix is needed only for them """
+    used = np.unique(M.indices)
+    columns = np.searchsorted(used, M.indices)
+    return used, scipy.sparse.csr_matrix((M.data, columns, M.indptr), \
+                                         shape = (M.shape[0], len(used)))
+
+
+def semantic_sim_matrix (path, index, M):
+    """ read_in_semantic_sim_matrix for the functions of the AnnotationIndex
+        index used in M. Returns (S, M) with the columns of M renumbered to
+        the rows and columns of S (see used_functions) """
+    used, M = used_functions(M)
+    S = read_in_semantic_sim_matrix(path, [index.functions[f] for f in used.tolist()])
+    return S, M
+
+
+def function_set_pairs(M, nodes1, nodes2):
+    """ Intern the function sets of the nodes (rows of the node x function
+        matrix M) and pair them up for the (nodes1, nodes2) arrays. Returns
+        (sets, pairs, inverse): the list of distinct function sets as tuples of
+        function ids, the distinct (set1, set2) pairs encoded as
+        set1 * len(sets) + set2, and the index of every node pair in pairs
+    """
+    set_ids = {}
+    node_to_set = np.empty(M.shape[0], dtype = np.int64)
+    for node in xrange(M.shape[0]):
+        terms = tuple(M.indices[M.indptr[node] : M.indptr[node + 1]])
+        node_to_set[node] = set_ids.setdefault(terms, len(set_ids))
+    sets = sorted(set_ids, key = set_ids.get)
+
+    pairs = node_to_set[nodes1] * len(sets) + node_to_set[nodes2]
+    unique_pairs, inverse = np.unique(pairs, return_inverse = True)
+    return sets, unique_pairs, inverse
+
+
+def semantic_weights(M, S, nodes1, nodes2, set_pairs = None):
+    """ semantic() for all the pairs of nodes in (nodes1, nodes2) arrays, where
+        M is the node x function matrix (see AnnotationIndex.matrix) and S the
+        function x function similarity matrix. Nodes with the same functions
+        in the same order share an id, so every distinct pair of function
+        sets is calculated only once. set_pairs is the result of
+        function_set_pairs for the same arguments, if already available. The
+        rows of M must be in set order (see AnnotationIndex.matrix): the
+        maxima are summed one at a time in that order, as semantic() does, so
+        the weights are identical to the ones of semantic()
+    """
+    if set_pairs is None:
+        set_pairs = function_set_pairs(M, nodes1, nodes2)
+    sets, unique_pairs, inverse = set_pairs
+
+    weights = np.zeros(len(unique_pairs))
+    for k, pair in enumerate(unique_pairs):
+        terms1 = np.array(sets[pair // len(sets)], dtype = np.int64)
+        terms2 = np.array(sets[pair % len(sets)], dtype = np.int64)
+        if len(terms1) == 0 or len(terms2) == 0:
+            continue
+        sim = S[np.ix_(terms1, terms2)]
+        sim1 = sum(np.maximum(sim.max(axis = 1), 0.0).tolist()) / len(terms1)
+        sim2 = sum(np.maximum(sim.max(axis = 0), 0.0).tolist()) / len(terms2)
+        weights[k] = max(sim1, sim2)
+
+    return weights[inverse]
+
+
+def graph_content_semantic(graph, id_to_protein, annotations, semantic_sim_file, path, binary = False):
     """ Builds interaction graph with content based weighs using Rasnik
-        similarity metric, and save it at the given path """
-    protein_to_functions = read_in_annotations(annotation_file)
-    functions_to_similarity = read_in_semantic_sim_file(semantic_sim_file)
-
-    with open(path, 'w') as out:
-        for e in graph.edges_iter():
-            terms1 = protein_to_functions.get(id_to_protein[e[0]], None)
-            terms2 = protein_to_functions.get(id_to_protein[e[1]], None)
-            if terms1 and terms2:
-                w = semantic(terms1, terms2, functions_to_similarity)
-                out.write('%d %d %f\n' % (e[0], e[1], w))
-            else:
-                out.write('%d %d %f\n' % (e[0], e[1], 0.0))
+        similarity metric, and save it at the given path (as binary edgelist
+        if binary is set). annotations is the path of the annotation file or
+        its AnnotationIndex """
+    n1, n2, W = content_weights(graph, id_to_protein, annotations, 'resnik', \
+                                semantic_sim_file)
+
+    save_edgelist(path, n1, n2, W, binary)
 
 
 #-------------------------------------------------------------------------------
 
-def graph_structure(graph, content_graph, path):
-    """ Builds interaction graph with structure based weighs
-        similarity metric, and save it at the given path """
-    A = scipy.sparse.csr_matrix(nx.google_matrix(graph, alpha = 1, weight = 'weight'))
-    W = nx.to_scipy_sparse_matrix(content_graph)
-    W2 = (W.dot(A) + A.transpose().dot(W)) * 0.5
+def row_dots(X, Y, rows1, rows2):
+    """ Dot products of the rows X[rows1[k]] and Y[rows2[k]] of two sparse
+        matrices, for all k """
+    return np.asarray(X[rows1].multiply(Y[rows2]).sum(axis = 1)).ravel()
+
+
+def structure_transition(graph):
+    """ Row stochastic transition matrix of the graph in CSR format, with the
+        rows of the dangling nodes left empty, and the mask of the dangling
+        nodes """
+    A = scipy.sparse.csr_matrix(adjacency_matrix(graph), dtype = np.float64)
+    weights_sum = np.asarray(A.sum(axis = 1)).ravel()
+    dangling = weights_sum == 0
+    A.data = A.data / np.repeat(weights_sum, np.diff(A.indptr))
+    return A, dangling
+
+
+def structure_matrix(graph, W, edges_only = False, transition = None, \
+                     rescale = True):
+    """ Structure weights (W.A + A'.W) / 2 rescaled in range 0-1, where W is
+        the content weights matrix and A the row stochastic transition matrix
+        of the graph, with uniform rows for the dangling nodes (as returned by
+        nx.google_matrix with alpha = 1). A is kept sparse, so no dense N x N
+        matrix is built. Content weights at a dangling node would spread over
+        a whole row and column of the result through the uniform rows, so
+        such W raise ValueError. Content weights built from the edges of the
+        graph never touch dangling nodes, and for them the result is the same
+        as with the dense matrix. With edges_only the weights are calculated
+        only at the edges of the graph (instead of the whole pattern of the
+        product) and rescaled by the maximum over those edges. transition is
+        the result of structure_transition for the graph, if already
+        available. If rescale is not set the weights are returned as they
+        are, before rescaling
+    """
+    N = graph.order()
+    A, dangling = transition if transition is not None else structure_transition(graph)
+    W = scipy.sparse.csr_matrix(W, dtype = np.float64)
+
+    if edges_only:
+        rows = np.repeat(np.arange(N), np.diff(A.indptr))
+        cols = A.indices
+        At = A.transpose().tocsr()
+        Wt = W.transpose().tocsr()
+        values = (row_dots(W, At, rows, cols) + row_dots(At, Wt, rows, cols)) * 0.5
+        W2 = scipy.sparse.coo_matrix((values, (rows, cols)), shape = (N, N)).tocsr()
+    else:
+        W2 = (W.dot(A) + A.transpose().dot(W)) * 0.5
+
+    # the dangling rows of A would add W.(d 1'/N) + (1 d'/N).W
+    dangling_nodes = np.where(dangling)[0]
+    if W[:, dangling_nodes].data.any() or W[dangling_nodes].data.any():
+        raise ValueError('Content weights at dangling nodes, the structure ' \
+                         'weights would be dense')
+
+    if edges_only:
+        W2.eliminate_zeros()
+    if not rescale:
+        return W2
+
     # rescaling in range 0-1
     max_val = W2.max()
-    W2 = W2.multiply(1.0 / max_val)
+    return W2.multiply(1.0 / max_val)
+
+
+def structure_rows(W, transition, rows, edges_only = False):
+    """ Structure weights (see structure_matrix), before rescaling, of the given
+        rows only. Returns them as an N x N CSR matrix whose other rows are
+        empty. transition is the result of structure_transition. The content
+        weights W are expected to be on the edges of the graph, so the
+        dangling nodes add nothing (see structure_matrix)
+    """
+    A = transition[0]
+    N = A.shape[0]
+    W = scipy.sparse.csr_matrix(W, dtype = np.float64)
+    At = A.transpose().tocsr()
+    rows = np.asarray(rows, dtype = np.int64)
+
+    if edges_only:
+        sub = A[rows]
+        r = np.repeat(rows, np.diff(sub.indptr))
+        c = sub.indices
+        Wt = W.transpose().tocsr()
+        values = (row_dots(W, At, r, c) + row_dots(At, Wt, r, c)) * 0.5
+    else:
+        sub = ((W[rows].dot(A) + At[rows].dot(W)) * 0.5).tocoo()
+        r, c, values = rows[sub.row], sub.col, sub.data
+
+    W2 = scipy.sparse.coo_matrix((values, (r, c)), shape = (N, N)).tocsr()
+    if edges_only:
+        W2.eliminate_zeros()
+    return W2
+
+
+def update_structure(W2, W, transition, rows, edges_only = False):
+    """ Replace the rows and the columns of the structure weights W2 (before
+        rescaling) that are set in the rows mask with the ones calculated
+        from the content weights W (see structure_rows). W2 is symmetric, so
+        the columns are the transposed rows
+    """
+    W2 = scipy.sparse.coo_matrix(W2)
+    keep = ~rows[W2.row] & ~rows[W2.col]
+    R = structure_rows(W, transition, np.where(rows)[0], edges_only).tocoo()
+    T = ~rows[R.col]
 
-    save_matrix_to_edgelist(W2, path)
+    return scipy.sparse.coo_matrix((np.concatenate((W2.data[keep], R.data, R.data[T])), \
+                                    (np.concatenate((W2.row[keep], R.row, R.col[T])), \
+                                     np.concatenate((W2.col[keep], R.col, R.row[T])))), \
+                                   shape = W2.shape).tocsr()
+
+
+def graph_structure(graph, content_graph, path, binary = False, edges_only = False):
+    """ Builds interaction graph with structure based weighs
+        similarity metric, and save it at the given path (as binary edgelist
+        if binary is set). See structure_matrix for edges_only """
+    W = nx.to_scipy_sparse_matrix(content_graph)
+    W2 = structure_matrix(graph, W, edges_only)
+
+    save_matrix_to_edgelist(W2, path, binary)
 
 
 #-------------------------------------------------------------------------------
 
-def graph_hybrid(content_graph, structure_graph, path):
+def graph_hybrid(content_graph, structure_graph, path, binary = False):
     """ Builds interaction graph with hybrid based weighs
-        similarity metric, and save it at the given path """
+        similarity metric, and save it at the given path (as binary edgelist
+        if binary is set) """
     W1 = nx.to_scipy_sparse_matrix(content_graph)
     W2 = nx.to_scipy_sparse_matrix(structure_graph)
     W3 = (W1 + W2) * 0.5
 
-    save_matrix_to_edgelist(W3, path)
+    save_matrix_to_edgelist(W3, path, binary)
+
+
+#-------------------------------------------------------------------------------
+
+def content_weights(graph, id_to_protein, annotations, metric = 'jaccard', \
+                    semantic_sim_file = None):
+    """ Content based weights of all the edges of the graph, returned as
+        (nodes1, nodes2, weights) arrays in graph.edges_iter() order. metric is
+        'jaccard', 'resnik' or 'wang', the semantic ones take the function
+        similarities from semantic_sim_file. annotations is the path of the
+        annotation file or its AnnotationIndex
+    """
+    index = annotation_index(annotations)
+    M = index.matrix(graph.order(), id_to_protein, set_order = True)
+    n1, n2 = edge_arrays(graph)
+
+    return n1, n2, pair_content_weights(index, M, n1, n2, metric, semantic_sim_file)
+
+
+def pair_content_weights(index, M, nodes1, nodes2, metric = 'jaccard', \
+                         semantic_sim_file = None):
+    """ Content based weights of the pairs of nodes in (nodes1, nodes2) arrays,
+        where M is the node x function matrix of the AnnotationIndex index,
+        in set order for the semantic metrics (see semantic_weights). See
+        content_weights for metric and semantic_sim_file
+    """
+    if metric == 'jaccard':
+        return jaccard_weights(M, nodes1, nodes2)
+    if metric in ('resnik', 'wang'):
+        S, M = semantic_sim_matrix(semantic_sim_file, index, M)
+        return semantic_weights(M, S, nodes1, nodes2)
+    raise ValueError('Unknown content metric %s' % metric)
+
+
+def edge_weights_matrix(nodes, nodes1, nodes2, weights):
+    """ Symmetric sparse matrix of the undirected weighted edges, with the
+        0-weight edges dropped. This is the matrix of the graph that
+        build_graph_from_edgelist would build from the saved edges """
+    nonzero = weights != 0
+    n1, n2, w = nodes1[nonzero], nodes2[nonzero], weights[nonzero]
+    loops = n1 == n2
+    W = scipy.sparse.coo_matrix((np.concatenate((w, w[~loops])), \
+                                 (np.concatenate((n1, n2[~loops])), \
+                                  np.concatenate((n2, n1[~loops])))), \
+                                shape = (nodes, nodes))
+    return W.tocsr()
+
+
+def weight_pipeline(graph, id_to_protein, annotations, metric = 'jaccard', \
+                    semantic_sim_file = None, content_path = None, \
+                    structure_path = None, hybrid_path = None, \
+                    edges_only = False, binary = False):
+    """ Content, structure and hybrid weighting of the graph in a single run,
+        with all the intermediate weights kept in memory as sparse matrices
+        instead of being saved and read back with build_graph_from_edgelist.
+        Returns {'content': W1, 'structure': W2, 'hybrid': W3}. Every graph
+        is also saved (as graph_content_*, graph_structure and graph_hybrid
+        save it) when its path is given. See content_weights for metric and
+        semantic_sim_file, and structure_matrix for edges_only
+    """
+    N = graph.order()
+    n1, n2, w = content_weights(graph, id_to_protein, annotations, metric, \
+                                semantic_sim_file)
+    if content_path:
+        save_edgelist(content_path, n1, n2, w, binary)
+
+    W1 = edge_weights_matrix(N, n1, n2, w)
+    W2 = structure_matrix(graph, W1, edges_only).tocsr()
+    if structure_path:
+        save_matrix_to_edgelist(W2, structure_path, binary)
+
+    W2.eliminate_zeros()
+    W3 = (W1 + W2) * 0.5
+    if hybrid_path:
+        save_matrix_to_edgelist(W3, hybrid_path, binary)
+
+    return {'content': W1, 'structure': W2, 'hybrid': W3}
+
+
+#-------------------------------------------------------------------------------
+
+def save_weights_snapshot(path, graph, id_to_protein, index, annotation_file, \
+                          settings, W1, W2):
+    """ Save what incremental_weight_pipeline needs to update the weights of
+        the next release in the directory at the given path: the graph cache
+        of the interaction graph, the annotation index, the content weights W1
+        and the structure weights W2 before rescaling (as CSR matrices) and the
+        settings of the run. The settings are written last, so an interrupted
+        save leaves no valid snapshot
+    """
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    settings_path = os.path.join(path, 'settings.npy')
+    if os.path.exists(settings_path):
+        os.remove(settings_path)
+
+    save_graph_cache(graph, os.path.join(path, 'graph'), id_to_protein)
+    index.save(os.path.join(path, 'annotations.npz'), annotation_file)
+    save_csr_matrix(scipy.sparse.csr_matrix(W1), os.path.join(path, 'content'))
+    save_csr_matrix(scipy.sparse.csr_matrix(W2), os.path.join(path, 'structure'))
+    np.save(settings_path, np.array(settings, dtype = str))
+
+
+def load_weights_snapshot(path, settings):
+    """ Load the snapshot saved with save_weights_snapshot as (graph, index, W1,
+        W2), where graph is a CachedGraph. Returns None if there is no snapshot
+        at the given path or it was saved with different settings """
+    settings_path = os.path.join(path, 'settings.npy')
+    if not os.path.exists(settings_path) or \
+            np.load(settings_path).tolist() != [str(s) for s in settings]:
+        return None
+
+    return load_graph_cache(os.path.join(path, 'graph'), None), \
+           AnnotationIndex.load(os.path.join(path, 'annotations.npz')), \
+           load_csr_matrix(os.path.join(path, 'content'), None), \
+           load_csr_matrix(os.path.join(path, 'structure'), None)
+
+
+def incremental_weight_pipeline(graph, id_to_protein, annotation_file, \
+                                snapshot_path, metric = 'jaccard', \
+                                semantic_sim_file = None, content_path = None, \
+                                structure_path = None, hybrid_path = None, \
+                                edges_only = False, binary = False):
+    """ weight_pipeline for a new release of the interaction data or of the
+        annotations, reusing the weights of the previous run kept in the
+        snapshot directory at snapshot_path (see save_weights_snapshot).
+        Nodes are matched with the previous release by protein name. Content
+        weights are recalculated only for the new edges and the edges of
+        proteins whose functions changed, structure weights only for the rows
+        (and columns) of the nodes whose content weights or transition
+        probabilities changed and of their old and new neighbours. Without a
+        snapshot of a run with the same settings everything is calculated.
+        The snapshot is updated for the next run. Returns the dictionary of
+        weight_pipeline with 'recomputed', the mask of the nodes whose
+        structure weights were recalculated
+    """
+    N = graph.order()
+    index = AnnotationIndex.from_file(annotation_file)
+    M = index.matrix(N, id_to_protein, set_order = True)
+    n1, n2 = edge_arrays(graph)
+    transition = structure_transition(graph)
+    settings = [metric, file_hash(semantic_sim_file) if semantic_sim_file else '', \
+                bool(edges_only)]
+
+    snapshot = load_weights_snapshot(snapshot_path, settings)
+    if snapshot is None:
+        w = pair_content_weights(index, M, n1, n2, metric, semantic_sim_file)
+        W1 = edge_weights_matrix(N, n1, n2, w)
+        W2 = structure_matrix(graph, W1, edges_only, transition, False).tocsr()
+        recomputed = np.ones(N, dtype = bool)
+    else:
+        old_graph, old_index, old_W1, old_W2 = snapshot
+        old_A = old_graph.adjacency()
+        old_of_new, new_of_old = node_mapping(id_to_protein, N, \
+                                              old_graph.id_to_protein, old_A.shape[0])
+        added = old_of_new < 0
+        old_edges = remap_matrix(old_A, new_of_old, N)
+        old_A = remap_matrix(row_stochastic(old_A), new_of_old, N)
+        old_W1 = remap_matrix(old_W1, new_of_old, N)
+
+        # content weights of the new edges and the edges of reannotated proteins
+        annotated = changed_annotations(index, old_index, N, id_to_protein) | added
+        known = has_edges(edge_keys(np.column_stack(old_edges.nonzero())), n1, n2)
+        redo = annotated[n1] | annotated[n2] | ~known
+        w = np.asarray(old_W1[n1, n2]).ravel() if len(n1) else np.zeros(0)
+        if redo.any():
+            w[redo] = pair_content_weights(index, M, n1[redo], n2[redo], metric, \
+                                           semantic_sim_file)
+        W1 = edge_weights_matrix(N, n1, n2, w)
+
+        # structure weights of the rows reached by the changes
+        changed = changed_rows(W1, old_W1) | changed_rows(transition[0], old_A) | added
+        recomputed = changed | neighbours(transition[0], changed) | \
+                     neighbours(old_A, changed)
+        W2 = update_structure(remap_matrix(old_W2, new_of_old, N), W1, transition, \
+                              recomputed, edges_only)
+
+    save_weights_snapshot(snapshot_path, graph, id_to_protein, index, \
+                          annotation_file, settings, W1, W2)
+
+    if content_path:
+        save_edgelist(content_path, n1, n2, w, binary)
+
+    W2 = W2.multiply(1.0 / W2.max()).tocsr()
+    if structure_path:
+        save_matrix_to_edgelist(W2, structure_path, binary)
+
+    W2.eliminate_zeros()
+    W3 = (W1 + W2) * 0.5
+    if hybrid_path:
+        save_matrix_to_edgelist(W3, hybrid_path, binary)
+
+    return {'content': W1, 'structure': W2, 'hybrid': W3, 'recomputed': recomputed}
+
+
+#-------------------------------------------------------------------------------
+
+def fused_weights(graph, id_to_protein, annotations, metrics, path = None, \
+                  edges_only = False):
+    """ Content, structure and hybrid weights of the edges of the graph for
+        several content metrics in a single sweep over the edge arrays.
+        metrics maps every metric ('jaccard', 'resnik' or 'wang') to its
+        semantic similarity file (None for jaccard). The annotation matrix,
+        the edge arrays, the function set pairs of the edges and the
+        transition matrix are calculated once and shared by all metrics.
+        Returns (nodes1, nodes2, columns, table) where table is E x C with
+        the weights of the edges in graph.edges_iter() order for the column
+        names in columns ('jaccard_content', 'jaccard_structure', ...).
+        The table is saved at path, if given, with the column names in a
+        first '#' line. The weights are the ones weight_pipeline calculates,
+        see structure_matrix for edges_only
+    """
+    N = graph.order()
+    index = annotation_index(annotations)
+    # jaccard does not depend on the numbering or the order of the functions
+    used, M = used_functions(index.matrix(N, id_to_protein, set_order = True))
+    functions = [index.functions[f] for f in used.tolist()]
+    n1, n2 = edge_arrays(graph)
+    set_pairs = None
+    transition = structure_transition(graph)
+
+    columns = []
+    table = []
+    for metric in sorted(metrics):
+        if metric == 'jaccard':
+            w = jaccard_weights(M, n1, n2)
+        elif metric in ('resnik', 'wang'):
+            if set_pairs is None:
+                set_pairs = function_set_pairs(M, n1, n2)
+            S = read_in_semantic_sim_matrix(metrics[metric], functions)
+            w = semantic_weights(M, S, n1, n2, set_pairs)
+        else:
+            raise ValueError('Unknown content metric %s' % metric)
+
+        W1 = edge_weights_matrix(N, n1, n2, w)
+        W2 = structure_matrix(graph, W1, edges_only, transition).tocsr()
+        structure = np.asarray(W2[n1, n2]).ravel()
+        hybrid = (np.asarray(W1[n1, n2]).ravel() + structure) * 0.5
+
+        columns += ['%s_content' % metric, '%s_structure' % metric, '%s_hybrid' % metric]
+        table += [w, structure, hybrid]
+
+    table = np.column_stack(table) if table else np.zeros((len(n1), 0))
+    if path:
+        with open(path, 'w') as out:
+            out.write('# node1 node2 %s\n' % ' '.join(columns))
+            write_columns(out, [n1, n2] + list(table.T), \
+                          '%d %d' + ' %f' * len(columns) + '\n')
+
+    return n1, n2, columns, table
 
 
 #-------------------------------------------------------------------------------
 
-def protein_term_graph(graph, id_to_protein, annotation_file, path, nodes_path):
-    """ Builds protein-term graph and saves it at the given path. The nodes
-        (proteins and terms) and their IDs are saved at nodes_path
+def protein_term_graph(graph, id_to_protein, annotations, path, nodes_path, binary = False):
+    """ Builds protein-term graph and saves it at the given path (as binary
+        edgelist if binary is set). The nodes (proteins and terms) and their
+        IDs are saved at nodes_path. annotations is the path of the annotation
+        file or its AnnotationIndex
     """
-    protein_to_functions = read_in_annotations(annotation_file)
+    index = annotation_index(annotations)
     ID = graph.order()
     function_to_id = {}
 
     for node in graph.nodes():
-        p = id_to_protein[node]
-        functions = protein_to_functions.get(p, set())
-        for f in functions:
+        r = index.protein_to_row.get(id_to_protein[node])
+        # the original set of the protein, so terms get the same ids
+        for f in index.function_set(r) if r is not None else ():
             if not f in function_to_id:
                 function_to_id[f] = ID
                 ID += 1
             graph.add_edge(node, function_to_id[f])
 
-    with open(path, 'w') as out:
-        for e in graph.edges_iter():
-            out.write('%d %d\n' % (e[0], e[1]))
+    n1, n2 = edge_arrays(graph)
+    save_edgelist(path, n1, n2, None, binary)
 
     with open(nodes_path, 'w') as out:
         for i in id_to_protein:
@@ -173,60 +633,366 @@ def protein_term_graph(graph, id_to_protein, annotation_file, path, nodes_path):
 
 #-------------------------------------------------------------------------------
 
-def random_walk_save (graph, from_node, to_node, restart_prob, path, max_iterations = 50, threshold = 1e-04):
+def write_pageranks(out, nodes, P):
+    """ Write the pageranks of the seed nodes (columns of P) to the opened out
+        file as 'seed node pagerank' lines """
+    nodes2 = np.arange(P.shape[0])
+    for c, node1 in enumerate(nodes):
+        write_edgelist(out, np.repeat(node1, P.shape[0]), nodes2, P[:, c])
+
+
+def save_pageranks_block(path, nodes, P, binary = False):
+    """ Append the pageranks of the seed nodes (columns of P) to the file at
+        the given path, either as text lines or as records of a binary
+        proximity store """
+    if binary:
+        append_proximity_rows(path, nodes, P)
+    else:
+        with open(path, 'a') as out:
+            write_pageranks(out, nodes, P)
+
+
+def random_walk_save (graph, from_node, to_node, restart_prob, path, max_iterations = 50, threshold = 1e-04, memory_mb = 256, binary = False):
     """ Calculate and save at the given path, personalized pageranks for all
         nodes of the graph within range [from_node, to_node]. max_iterations and
         threshold are used for estimating the convergence, and restart_prob is
-        the damping factor
+        the damping factor. Seeds are processed in blocks that fit in memory_mb
+        megabytes. If binary is set the pageranks are appended to a binary
+        proximity store (see proximity_store) instead of a text file
     """
     # preprocess the graph
     remove_zero_weights_from_graph(graph)
-    graph = graph.to_directed()
-
-    #personalization = dict((i, 0.0) for i in graph.nodes_iter())
-
-
-    for node1 in xrange(from_node, to_node):
-        #personalization[node1] = 1.0
+    Q, dangling = transition_matrix(adjacency_matrix(graph))
+
+    for nodes, P in iter_pagerank_blocks(Q, dangling, restart_prob, \
+                                         xrange(from_node, to_node), \
+                                         max_iterations, threshold, memory_mb):
+        save_pageranks_block(path, nodes, P, binary)
+
+
+def random_walk_save_sweep (graph, restart_probs, paths, max_iterations = 50, threshold = 1e-04, memory_mb = 256, norm = 'l1', warm_start = True, binary = False):
+    """ random_walk_save of all the nodes of the graph for every restart
+        probability in restart_probs, the pageranks of restart_probs[k] are
+        saved at paths[k]. Solves are warm-started from the pageranks of
+        neighbouring seeds and of the previous restart probability (see
+        pagerank_sweep) and converge on the L1 residual by default. Returns
+        a restart probability to array dictionary with the number of
+        iterations every seed took
+    """
+    # preprocess the graph
+    remove_zero_weights_from_graph(graph)
+    A = adjacency_matrix(graph)
+
+    iterations = dict((alpha, np.zeros(graph.order(), dtype = np.int64)) \
+                      for alpha in restart_probs)
+    path_of = dict(zip(restart_probs, paths))
+    for alpha, nodes, P, it in pagerank_sweep(A, restart_probs, xrange(graph.order()), \
+                                              max_iterations, threshold, memory_mb, \
+                                              norm, warm_start):
+        save_pageranks_block(path_of[alpha], nodes, P, binary)
+        iterations[alpha][nodes] = it
+
+    return iterations
+
+
+def random_walk_save_sparse (graph, from_node, to_node, restart_prob, path, top_k = None, epsilon = None, keep_edges = True, max_iterations = 50, threshold = 1e-04, memory_mb = 256):
+    """ random_walk_save that keeps only the top_k largest pageranks of every
+        seed and/or the ones above epsilon (see select_proximities), together
+        with the entries at the edges of the graph if keep_edges is set, and
+        saves them at the given path as sparse proximities (see
+        save_sparse_proximities), so the output is O(N * top_k) instead of
+        N x N
+    """
+    # preprocess the graph
+    remove_zero_weights_from_graph(graph)
+    A = adjacency_matrix(graph)
+    Q, dangling = transition_matrix(A)
+
+    rows, cols, values = [], [], []
+    seeds = np.arange(from_node, to_node)
+    for nodes, P in iter_pagerank_blocks(Q, dangling, restart_prob, seeds, \
+                                         max_iterations, threshold, memory_mb):
+        keep = np.zeros(P.shape, dtype = bool)
+        keep[select_proximities(P, top_k, epsilon)] = True
+        if keep_edges:
+            sub = A[nodes]
+            keep[sub.indices, np.repeat(np.arange(len(nodes)), np.diff(sub.indptr))] = True
+        nodes2, columns = np.nonzero(keep)
+        rows.append(nodes[columns])
+        cols.append(nodes2)
+        values.append(P[nodes2, columns])
+
+    N = graph.order()
+    M = scipy.sparse.coo_matrix((np.concatenate([np.zeros(0)] + values), \
+                                 (np.concatenate([seeds[:0]] + rows), \
+                                  np.concatenate([seeds[:0]] + cols))), shape = (N, N))
+    save_sparse_proximities(path, M, seeds)
 
-        p = pagerank2(graph, restart_prob, node1, max_iterations, threshold)
-        #p = nx.pagerank(graph, 1-restart_prob, personalization, max_iterations, threshold, personalization, 'weight')
 
-        with open(path, 'a') as out:
-            node2 = 0
-            while node2 < len(p):
-                out.write('%d %d %f\n' % (node1, node2, p[node2]))
-                node2 += 1
+#-------------------------------------------------------------------------------
 
-        #personalization[node1] = 0.0
+def random_walk_chunk (args):
+    """ Worker of random_walk_save_parallel. Loads the shared (memory-mapped)
+        transition matrix and saves the pageranks of the seeds within range
+        [from_node, to_node) in its own shard file
+    """
+    matrix_path, from_node, to_node, restart_prob, shard_path, \
+        max_iterations, threshold, memory_mb, binary = args
+    Q, dangling = load_transition_matrix(matrix_path)
+
+    for nodes, P in iter_pagerank_blocks(Q, dangling, restart_prob, \
+                                         xrange(from_node, to_node), \
+                                         max_iterations, threshold, memory_mb):
+        save_pageranks_block(shard_path, nodes, P, binary)
+
+    return from_node
+
+
+def random_walk_save_parallel (graph, from_node, to_node, restart_prob, path, max_iterations = 50, threshold = 1e-04, memory_mb = 256, processes = None, chunk_size = 64, binary = False):
+    """ Same as random_walk_save, but the seeds within range [from_node, to_node]
+        are split in chunks of chunk_size nodes that are handed out dynamically
+        to a pool of processes (cpu_count() by default). The transition matrix
+        is built once and shared with the workers through memory-mapped files,
+        every chunk is saved to its own shard and the shards are appended to
+        path in seed order, so the result is the same as the serial one.
+        memory_mb is the memory budget of every worker and binary has the same
+        meaning as in random_walk_save
+    """
+    # preprocess the graph
+    remove_zero_weights_from_graph(graph)
+    Q, dangling = transition_matrix(adjacency_matrix(graph))
+
+    tmp_dir = tempfile.mkdtemp(prefix = 'random_walk_', \
+                               dir = os.path.dirname(os.path.abspath(path)))
+    try:
+        matrix_path = os.path.join(tmp_dir, 'transition')
+        save_transition_matrix(Q, dangling, matrix_path)
+        del Q
+
+        chunks = [(matrix_path, start, min(start + chunk_size, to_node), \
+                   restart_prob, os.path.join(tmp_dir, 'shard_%d' % start), \
+                   max_iterations, threshold, memory_mb, binary) \
+                  for start in xrange(from_node, to_node, chunk_size)]
+
+        pool = multiprocessing.Pool(processes)
+        try:
+            for _ in pool.imap_unordered(random_walk_chunk, chunks):
+                pass
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+        # deterministic merge
+        shards = [chunk[4] for chunk in chunks if os.path.exists(chunk[4])]
+        if binary:
+            merge_proximity_stores(path, shards)
+        else:
+            with open(path, 'a') as out:
+                for shard in shards:
+                    with open(shard, 'r') as in_file:
+                        shutil.copyfileobj(in_file, out)
+    finally:
+        shutil.rmtree(tmp_dir)
 
 
 #-------------------------------------------------------------------------------
 
-def random_walk_graph (graph, pagerank_paths, path):
+def random_walk_graph (graph, pagerank_paths, path, binary = False):
     """ Build the graph with random walk based distances where
         w{n1, n2} = (p_n2[n1] + p_n1[n2]) / 2, where p_ni is the stationary
-        distribution obtained with personalized pagerank from ni
+        distribution obtained with personalized pagerank from ni.
+        pagerank_paths is either the text file or the binary proximity store
+        written by random_walk_save, or the sparse proximities written by
+        random_walk_save_sparse. The graph is saved as binary edgelist if
+        binary is set
     """
+    if is_proximity_store(pagerank_paths) or is_sparse_proximities(pagerank_paths):
+        return random_walk_graph_from_store(graph, pagerank_paths, path, binary)
+
     edges = {}
-    with open(pagerank_paths, 'r') as in_file:
-        with open(path, 'w') as out_file:
-            for line in in_file:
-                tokens = line.split()
-                n1 = int(tokens[0])
-                n2 = int(tokens[1])
-                w = float(tokens[2])
-                if graph.has_edge(n1, n2):
-                    e = (min(n1, n2), max(n1, n2))
-                    d = 1.0 - w
-                    if e in edges:
-                        edges[e] = (edges[e] + d) / 2.0
-                        out_file.write('%d %d %f\n' % (e[0], e[1], edges[e]))
-                    else:
-                        edges[e] = d
-
-    return edges                		
-	
+    written = []
+    keys = edge_keys(graph.edges(), graph.is_directed())
+    for nodes1, nodes2, weights in iter_edgelist_chunks(pagerank_paths):
+        found = has_edges(keys, nodes1, nodes2)
+        for n1, n2, w in itertools.izip(nodes1[found].tolist(), \
+                                        nodes2[found].tolist(), \
+                                        weights[found].tolist()):
+            e = (min(n1, n2), max(n1, n2))
+            d = 1.0 - w
+            if e in edges:
+                edges[e] = (edges[e] + d) / 2.0
+                written.append((e[0], e[1], edges[e]))
+            else:
+                edges[e] = d
+
+    written = np.array(written).reshape(-1, 3)
+    save_edgelist(path, written[:, 0], written[:, 1], written[:, 2], binary)
+
+    return edges
+
+
+def random_walk_graph_from_store (graph, store_path, path, binary = False):
+    """ random_walk_graph over a binary proximity store or sparse proximities:
+        p_n1[n2] and p_n2[n1] are gathered for all the edges of the graph at
+        once from the memory-mapped store (or the sparse matrix). Edges are
+        written in the same order as they are when the text file holds the
+        seeds in increasing order
+    """
+    if is_sparse_proximities(store_path):
+        M, seeds = read_sparse_proximities(store_path)
+        gather = lambda n1, n2: gather_sparse_proximities(M, seeds, n1, n2)
+    else:
+        rows, P = read_proximity_store(store_path)
+        gather = lambda n1, n2: gather_proximities(rows, P, n1, n2)
+    E = np.array(graph.edges(), dtype = np.int64).reshape(-1, 2)
+    lo = E.min(axis = 1)
+    hi = E.max(axis = 1)
+
+    d1 = 1.0 - gather(lo, hi)
+    d2 = 1.0 - gather(hi, lo)
+    both = ~np.isnan(d1) & ~np.isnan(d2) & (lo != hi)
+
+    edges = {}
+    for i in np.where(~both & (~np.isnan(d1) | ~np.isnan(d2)))[0]:
+        edges[(int(lo[i]), int(hi[i]))] = d1[i] if not np.isnan(d1[i]) else d2[i]
+
+    order = np.lexsort((lo[both], hi[both]))
+    lo, hi, d = lo[both][order], hi[both][order], ((d1 + d2) / 2.0)[both][order]
+    edges.update(itertools.izip(itertools.izip(lo.tolist(), hi.tolist()), d.tolist()))
+    save_edgelist(path, lo, hi, d, binary)
+
+    return edges
+
+
+#-------------------------------------------------------------------------------
+
+def random_walk_edges (graph, restart_prob, path, max_iterations = 50, threshold = 1e-04, memory_mb = 256, binary = False):
+    """ Build the same graph as random_walk_save followed by random_walk_graph,
+        without saving the pageranks. Personalized pageranks are calculated in
+        blocks of seeds (see random_walk_save for the parameters) and only the
+        entries at the edges of the (undirected) graph are kept from every
+        block, so the memory used is O(E) and nothing but the resulting
+        edgelist is written to disk (as binary edgelist if binary is set)
+    """
+    # preprocess the graph
+    remove_zero_weights_from_graph(graph)
+    A = adjacency_matrix(graph)
+    A.sort_indices()
+    Q, dangling = transition_matrix(A)
+
+    # prox[k] = p_n1[n2] for the k-th entry (n1, n2) of A
+    prox = np.zeros(A.nnz)
+    for nodes, P in iter_pagerank_blocks(Q, dangling, restart_prob, \
+                                         xrange(graph.order()), \
+                                         max_iterations, threshold, memory_mb):
+        first, last = A.indptr[nodes[0]], A.indptr[nodes[-1] + 1]
+        columns = np.repeat(np.arange(len(nodes)), np.diff(A.indptr[nodes[0] : nodes[-1] + 2]))
+        prox[first : last] = P[A.indices[first : last], columns]
+
+    X = scipy.sparse.csr_matrix((prox, A.indices, A.indptr), shape = A.shape)
+    # the pattern is symmetric, so the transposed entries are aligned with X's
+    XT = X.transpose().tocsr()
+    XT.sort_indices()
+
+    n1 = np.repeat(np.arange(A.shape[0]), np.diff(A.indptr))
+    n2 = A.indices
+    upper = n1 < n2
+    d = 1.0 - (X.data + XT.data) / 2.0
+
+    # same order as random_walk_graph
+    order = np.lexsort((n1[upper], n2[upper]))
+    n1, n2, d = n1[upper][order], n2[upper][order], d[upper][order]
+
+    edges = dict(itertools.izip(itertools.izip(n1.tolist(), n2.tolist()), d.tolist()))
+    save_edgelist(path, n1, n2, d, binary)
+
+    return edges
+
+
+#-------------------------------------------------------------------------------
+
+def random_walk_save_incremental (graph, id_to_protein, restart_prob, path, snapshot_path, tolerance = 1e-03, max_iterations = 50, threshold = 1e-04, memory_mb = 256):
+    """ random_walk_save for all the nodes of the graph into the binary
+        proximity store at path (replaced if it exists), reusing the pageranks
+        of the previous release of the graph kept in the snapshot directory at
+        snapshot_path: the graph cache of the previous graph ('graph') and
+        its proximity store ('pageranks'). Nodes are matched by protein name.
+        The pagerank of a seed is recalculated only when the old one puts
+        more than tolerance of its mass on nodes whose transition
+        probabilities changed (or that were removed), otherwise the old one
+        is kept as it is, without iterating it again on the new graph. If e
+        is the L1 error of the stored pagerank, the L1 distance of a kept one
+        from the exact pagerank of the new graph is at most
+        e + 2 * (1 - restart_prob) / restart_prob * (mass + e). e comes from
+        the power iteration and the float32 store and is not bounded by
+        threshold, which limits the largest change of an entry and not the
+        L1 residual; it can be well above the change of the graph itself.
+        The snapshot is updated for the next run. Returns the mask of the
+        recalculated seeds
+    """
+    # preprocess the graph
+    remove_zero_weights_from_graph(graph)
+    A = adjacency_matrix(graph)
+    Q, dangling = transition_matrix(A)
+    N = A.shape[0]
+
+    settings_path = os.path.join(snapshot_path, 'settings.npy')
+    settings = [str(s) for s in (restart_prob, max_iterations, threshold)]
+    store_path = os.path.join(snapshot_path, 'pageranks')
+    recompute = np.ones(N, dtype = bool)
+    old_rows = np.empty(N, dtype = np.int64)
+    old_rows.fill(-1)
+
+    if os.path.exists(settings_path) and np.load(settings_path).tolist() == settings:
+        old_graph = load_graph_cache(os.path.join(snapshot_path, 'graph'), None)
+        old_A = old_graph.adjacency()
+        old_of_new, new_of_old = node_mapping(id_to_protein, N, \
+                                              old_graph.id_to_protein, old_A.shape[0])
+        changed = changed_rows(row_stochastic(A), \
+                               remap_matrix(row_stochastic(old_A), new_of_old, N))
+
+        # changes in the ids of the previous graph
+        old_changed = new_of_old < 0
+        old_changed[old_of_new[changed & (old_of_new >= 0)]] = True
+        rows, P_old = read_proximity_store(store_path)
+        mass = P_old.dot(old_changed.astype(np.float32))
+
+        matched = old_of_new >= 0
+        old_rows[matched] = rows[old_of_new[matched]]
+        stored = old_rows >= 0
+        recompute[stored] = mass[old_rows[stored]] > tolerance
+        kept_old = np.where(new_of_old >= 0)[0]
+        kept_new = new_of_old[kept_old]
+
+    create_proximity_store(path, N)
+    step = pagerank_block_size(N, memory_mb)
+    for start in xrange(0, N, step):
+        block = np.arange(start, min(start + step, N))
+        P = np.zeros((N, len(block)))
+        redo = recompute[block]
+        if redo.any():
+            P[:, redo] = personalized_pagerank_block(Q, dangling, restart_prob, \
+                                                     block[redo], max_iterations, \
+                                                     threshold)
+        for c in np.where(~redo)[0]:
+            P[kept_new, c] = P_old[old_rows[block[c]], kept_old]
+        append_proximity_rows(path, block, P)
+
+    # new snapshot
+    if not os.path.isdir(snapshot_path):
+        os.makedirs(snapshot_path)
+    if os.path.exists(settings_path):
+        os.remove(settings_path)
+    save_graph_cache(graph, os.path.join(snapshot_path, 'graph'), id_to_protein)
+    shutil.copyfile(path, store_path + '.tmp')
+    os.rename(store_path + '.tmp', store_path)
+    np.save(settings_path, np.array(settings, dtype = str))
+
+    return recompute
+
 
 #-------------------------------------------------------------------------------
 
@@ -0,0 +1,100 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import scipy.sparse
+
+
+# Helpers to compare two releases of the same data. Node ids are assigned by
+# build_graph in reading order, so the ids of the two versions are matched
+# through the protein names and the matrices of the previous version are
+# remapped to the ids of the new one before they are compared.
+
+
+#-------------------------------------------------------------------------------
+
+def node_mapping(id_to_protein, nodes, old_id_to_protein, old_nodes):
+    """ Match the nodes 0..nodes-1 of the new graph with the nodes
+        0..old_nodes-1 of the previous one by protein name. Returns
+        (old_of_new, new_of_old) arrays, -1 marks the nodes without a
+        counterpart (new and removed proteins)
+    """
+    protein_to_old = dict((p, i) for i, p in old_id_to_protein.iteritems())
+    old_of_new = np.empty(nodes, dtype = np.int64)
+    old_of_new.fill(-1)
+    for node in xrange(nodes):
+        old_of_new[node] = protein_to_old.get(id_to_protein.get(node), -1)
+
+    new_of_old = np.empty(old_nodes, dtype = np.int64)
+    new_of_old.fill(-1)
+    matched = old_of_new >= 0
+    new_of_old[old_of_new[matched]] = np.where(matched)[0]
+    return old_of_new, new_of_old
+
+
+def remap_matrix(M, new_of_old, nodes):
+    """ The square sparse matrix M of the previous version in the ids of the
+        new one (see node_mapping), as a nodes x nodes CSR matrix. Entries of
+        removed nodes are dropped """
+    M = scipy.sparse.coo_matrix(M)
+    rows = new_of_old[M.row]
+    cols = new_of_old[M.col]
+    keep = (rows >= 0) & (cols >= 0)
+    return scipy.sparse.coo_matrix((M.data[keep], (rows[keep], cols[keep])), \
+                                   shape = (nodes, nodes)).tocsr()
+
+
+#-------------------------------------------------------------------------------
+
+def changed_rows(A, B, tolerance = 0.0):
+    """ Boolean mask of the rows where the sparse matrices A and B (of the same
+        shape) differ by more than tolerance in some entry """
+    D = (scipy.sparse.csr_matrix(A) - scipy.sparse.csr_matrix(B)).tocsr()
+    rows = np.repeat(np.arange(D.shape[0]), np.diff(D.indptr))
+    changed = np.zeros(D.shape[0], dtype = bool)
+    changed[rows[np.absolute(D.data) > tolerance]] = True
+    return changed
+
+
+def neighbours(A, mask):
+    """ Boolean mask of the nodes with an entry in the rows of the adjacency
+        matrix A that are set in mask """
+    found = np.zeros(A.shape[1], dtype = bool)
+    found[scipy.sparse.csr_matrix(A)[np.where(mask)[0]].indices] = True
+    return found
+
+
+def row_stochastic(A):
+    """ The sparse matrix A with every row divided by its sum (rows that sum
+        to 0 are left as they are) """
+    A = scipy.sparse.csr_matrix(A, dtype = np.float64)
+    sums = np.asarray(A.sum(axis = 1)).ravel()
+    sums[sums == 0] = 1.0
+    A.data = A.data / np.repeat(sums, np.diff(A.indptr))
+    return A
+
+
+#-------------------------------------------------------------------------------
+
+def changed_annotations(index, old_index, nodes, id_to_protein):
+    """ Boolean mask of the nodes 0..nodes-1 whose protein has a different set
+        of functions in the annotation index than in old_index. Functions are
+        matched by name, a protein missing from an index has no functions
+    """
+    M = index.matrix(nodes, id_to_protein)
+    old_M = old_index.matrix(nodes, id_to_protein).tocoo()
+
+    # functions that only the old index has go after the ones of the new index
+    columns = np.empty(len(old_index.functions), dtype = np.int64)
+    extra = len(index.functions)
+    for f, name in enumerate(old_index.functions):
+        columns[f] = index.function_to_id.get(name, -1)
+        if columns[f] < 0:
+            columns[f] = extra
+            extra += 1
+
+    shape = (nodes, extra)
+    old_M = scipy.sparse.coo_matrix((old_M.data, (old_M.row, columns[old_M.col])), \
+                                    shape = shape)
+    M = scipy.sparse.csr_matrix((M.data, M.indices, M.indptr), shape = shape)
+    return changed_rows(M, old_M)
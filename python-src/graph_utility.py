@@ -3,122 +3,297 @@
 
 import networkx as nx
 import multiprocessing
+import itertools
 import math
+import os
+import shutil
+import tempfile
+import traceback
 import numpy as np
 import scipy
+import scipy.sparse
 from interaction_graph_builder import *
+from edgelist_io import *
+from csr_store import *
+from distance_store import *
+from annotation_index import *
 from graph_preprocessing import *
 from operator import itemgetter
 
 
 #-------------------------------------------------------------------------------
 
+# distance of the node pairs without a path in uint8 distance rows
+UNREACHABLE = 255
+
+
+def bfs_distances(A, source):
+    """ Distances from the source node to all the nodes of the graph with
+        adjacency matrix A (CSR, row i holds the out-edges of node i), found
+        with a level-synchronous BFS. Returns uint8 row, UNREACHABLE for the
+        nodes that can not be reached
+    """
+    dist = np.empty(A.shape[0], dtype = np.uint8)
+    dist.fill(UNREACHABLE)
+    dist[source] = 0
+    frontier = np.array([source])
+    level = 0
+
+    while len(frontier):
+        level += 1
+        if level >= UNREACHABLE:
+            raise ValueError('Distances over %d do not fit in uint8' % (UNREACHABLE - 1))
+        starts = A.indptr[frontier]
+        degrees = A.indptr[frontier + 1] - starts
+        # positions of all the out-edges of the frontier in A.indices
+        offsets = np.arange(degrees.sum()) - np.repeat(np.cumsum(degrees) - degrees, degrees)
+        neighbors = A.indices[np.repeat(starts, degrees) + offsets]
+        frontier = np.unique(neighbors[dist[neighbors] == UNREACHABLE])
+        dist[frontier] = level
+
+    return dist
+
+
+def bfs_distances_multi(A, sources):
+    """ Bit-parallel BFS from up to 64 sources at once: every node keeps a 64
+        bit mask of the sources that reached it, and one level of all the
+        searches is a single OR-gather over the CSR adjacency. Returns
+        len(sources) x N uint8 matrix of distances (see bfs_distances)
+    """
+    if len(sources) > 64:
+        raise ValueError('At most 64 sources per pass')
+    N = A.shape[0]
+    # in-edges of node v are in row v of the transposed matrix
+    At = A.transpose().tocsr()
+    nonempty = np.diff(At.indptr) > 0
+    starts = At.indptr[:-1][nonempty]
+
+    dist = np.empty((len(sources), N), dtype = np.uint8)
+    dist.fill(UNREACHABLE)
+    frontier = np.zeros(N, dtype = np.uint64)
+    for b, source in enumerate(sources):
+        frontier[source] |= np.uint64(1) << np.uint64(b)
+        dist[b, source] = 0
+    visited = frontier.copy()
+    bits = np.arange(len(sources), dtype = np.uint64)
+    level = 0
+
+    while frontier.any():
+        level += 1
+        if level >= UNREACHABLE:
+            raise ValueError('Distances over %d do not fit in uint8' % (UNREACHABLE - 1))
+        reached = np.zeros(N, dtype = np.uint64)
+        if len(starts):
+            reached[nonempty] = np.bitwise_or.reduceat(frontier[At.indices], starts)
+        frontier = reached & ~visited
+        visited |= frontier
+
+        nodes = np.nonzero(frontier)[0]
+        found = ((frontier[nodes][:, None] >> bits) & np.uint64(1)).astype(bool)
+        node_idx, source_idx = np.nonzero(found)
+        dist[source_idx, nodes[node_idx]] = level
+
+    return dist
+
+
+def iter_shortest_path_rows(A, sources, bit_parallel = True):
+    """ Yield (source, uint8 distances row) for every source node, the rows are
+        computed 64 sources per pass with bfs_distances_multi, or one source
+        at a time with bfs_distances if bit_parallel is not set
+    """
+    sources = list(sources)
+    step = 64 if bit_parallel else 1
+    for i in xrange(0, len(sources), step):
+        block = sources[i : i + step]
+        if bit_parallel:
+            rows = bfs_distances_multi(A, block)
+        else:
+            rows = [bfs_distances(A, block[0])]
+        for source, row in itertools.izip(block, rows):
+            yield source, row
+
+
 def calculate_shortest_paths(graph, start_node, end_node, path):
     """Calculates shortest paths going from all nodes within the range
        start_node - end_node, calculated distances are saved at the given path"""
-    #distances = {}
-    for i in xrange(start_node, end_node):
-        if graph.has_node(i):
-            for j in xrange(i+1, graph.order()):
-                if graph.has_node(i):
-                    try:
-                        distance = nx.shortest_path_length(graph, i, j)
-                        with open(path, 'a') as out:
-                            out.write('%d %d %d\n' % (i, j, distance))
-                    except nx.NetworkXNoPath:
-                        continue
-
+    A = adjacency_matrix(graph)
+    sources = [i for i in xrange(start_node, end_node) if graph.has_node(i)]
 
+    with open(path, 'a') as out:
+        for i, row in iter_shortest_path_rows(A, sources):
+            j = np.arange(i + 1, graph.order())
+            j = j[row[i + 1:] != UNREACHABLE]
+            write_edgelist(out, np.repeat(i, len(j)), j, row[j], line = '%d %d %d\n')
 
 
 #-------------------------------------------------------------------------------
 
-def save_all_shortest_paths(graph, path):
-    """Calculate with multiprocessing all shortest paths within the graph"""
-    cpus = multiprocessing.cpu_count()
-    step = graph.order() / float(cpus)
-    starting = 0
-
-    jobs = []
-    for i in range(cpus):
-        p = multiprocessing.Process(target = calculate_shortest_paths, \
-                                    args = (graph, \
-                                            int(starting), \
-                                            int(math.ceil(starting + step)), \
-                                            '%s_%d' % (path, i)))
-        jobs.append(p)
-        p.start()
-        starting = math.ceil(starting + step)
+def shortest_paths_chunk(args):
+    """ Worker of save_all_shortest_paths. Calculates shortest paths going from
+        all nodes within the range [start_node, end_node) over the shared
+        (memory-mapped) adjacency and saves them in the distance store.
+        Returns (start_node, None) or (start_node, traceback) if it failed
+    """
+    adjacency_path, path, start_node, end_node = args
+    try:
+        A = load_csr_matrix(adjacency_path)
+        nodes, diameter, data = open_distance_store(path, 'r+')
+        for i, row in iter_shortest_path_rows(A, xrange(start_node, end_node)):
+            write_distance_row(data, nodes, i, row, UNREACHABLE)
+        data.flush()
+        return start_node, None
+    except Exception:
+        return start_node, traceback.format_exc()
+
+
+def read_progress(progress_path, nodes, chunk_size):
+    """ Starting nodes of the chunks already saved by an interrupted
+        save_all_shortest_paths run, None if there is no run to resume """
+    if not os.path.exists(progress_path):
+        return None
+    with open(progress_path, 'r') as in_file:
+        lines = in_file.read().split('\n')
+    if lines[0] != '%d %d' % (nodes, chunk_size):
+        return None
+    return set(int(line) for line in lines[1:] if line)
+
+
+def save_all_shortest_paths(graph, path, processes = None, chunk_size = 64):
+    """Calculate with multiprocessing all shortest paths within the graph and
+       save them in a single distance store at the given path, with the
+       diameter of the graph in its header.
+       The adjacency is shared read-only with a pool of processes
+       (cpu_count() by default) through memory-mapped files and the source
+       nodes are handed out dynamically in chunks of chunk_size nodes (one
+       bit-parallel BFS pass for chunks of 64). Every completed chunk is
+       recorded in path.progress, so a killed run started again with the same
+       arguments only calculates the missing chunks. Failed chunks are
+       reported, and raised as RuntimeError once all the others are done"""
+    N = graph.order()
+    progress_path = '%s.progress' % path
+    done = read_progress(progress_path, N, chunk_size) if os.path.exists(path) else None
+    if done is None:
+        create_distance_store(path, N)
+        done = set()
+        with open(progress_path, 'w') as progress:
+            progress.write('%d %d\n' % (N, chunk_size))
+
+    tmp_dir = tempfile.mkdtemp(prefix = 'shortest_paths_', \
+                               dir = os.path.dirname(os.path.abspath(path)))
+    failed = []
+    try:
+        adjacency_path = os.path.join(tmp_dir, 'adjacency')
+        save_csr_matrix(adjacency_matrix(graph), adjacency_path)
+        chunks = [(adjacency_path, path, start, min(start + chunk_size, N)) \
+                  for start in xrange(0, N, chunk_size) if not start in done]
+
+        pool = multiprocessing.Pool(processes)
+        try:
+            with open(progress_path, 'a') as progress:
+                for start, error in pool.imap_unordered(shortest_paths_chunk, chunks):
+                    if error is None:
+                        progress.write('%d\n' % start)
+                        progress.flush()
+                    else:
+                        print 'Chunk starting at node %d failed:\n%s' % (start, error)
+                        failed.append(start)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    if failed:
+        raise RuntimeError('%d chunks failed, run again to resume them' % len(failed))
+
+    write_distance_header(path, N, max_stored_distance(path))
+    os.remove(progress_path)
 
 
 #-------------------------------------------------------------------------------
 
 def graph_diameter(path):
-    """Find the graph diameter from shortest path's files generated with
+    """Find the graph diameter from the distance store generated with
        save_all_shortest_paths function"""
-    max_dist = -1;
-    for i in xrange(8):
-        with open('%s_%d' % (path, i), 'r') as in_file:
-            for line in in_file:
-                tokens = line.split()
-                d = int(tokens[2])
-                if d > max_dist:
-                    max_dist = d
-
-    return max_dist
+    return store_diameter(path)
 
 
 #-------------------------------------------------------------------------------
 
 def combine_and_sort_distance_files(distance_files, path):
-    """Combine all distance files into single file with lines sorted by
-       distance and save the new file at the given path"""
+    """Write all the distances from the distance store into a single text file
+       with 'node node distance' lines sorted by distance and save the new
+       file at the given path. The store is read once: every block of pairs
+       is bucketed by distance into per-distance spill files (distances
+       1..diameter, self-distances are not stored), which are then
+       concatenated and removed, so pairs at the same distance keep their
+       (node, node) order"""
     diameter = graph_diameter(distance_files)
-
-    for k in xrange(1, diameter + 1):
-        for i in xrange(8):
-            with open('%s_%d' % (distance_files, i), 'r') as in_file:
-                for line in in_file:
-                    tokens = line.split()
-                    d = int(tokens[2])
-                    if d == k:
-                        with open(path, 'a') as out:
-                            out.write(line)
+    tmp_dir = tempfile.mkdtemp(prefix = 'distances_', \
+                               dir = os.path.dirname(os.path.abspath(path)))
+    spill_paths = dict((k, os.path.join(tmp_dir, 'distance_%d' % k)) \
+                       for k in xrange(1, diameter + 1))
+    try:
+        spills = {}
+        try:
+            for k in xrange(1, diameter + 1):
+                spills[k] = open(spill_paths[k], 'w')
+            for nodes1, nodes2, d in iter_distance_blocks(distance_files):
+                order = np.argsort(d, kind = 'mergesort')
+                bounds = np.cumsum(np.bincount(d, minlength = diameter + 1))
+                for k in xrange(1, diameter + 1):
+                    bucket = order[bounds[k - 1] : bounds[k]]
+                    if len(bucket):
+                        write_edgelist(spills[k], nodes1[bucket], nodes2[bucket], \
+                                       d[bucket], line = '%d %d %d\n')
+        finally:
+            for spill in spills.values():
+                spill.close()
+
+        with open(path, 'a') as out:
+            for k in xrange(1, diameter + 1):
+                with open(spill_paths[k], 'r') as in_file:
+                    shutil.copyfileobj(in_file, out)
+                os.remove(spill_paths[k])
+    finally:
+        shutil.rmtree(tmp_dir)
 
 
 #-------------------------------------------------------------------------------
 
-def read_in_annotations(annotation_file):
-    """ Read in the file that contains the protein annotations, and return
-        protein to function dictionary """
-    protein_to_functions = {}
-    with open(annotation_file, 'r') as in_file:
-        for line in in_file:
-            tokens = line.split('\t')
-            if not tokens[1] in protein_to_functions:
-                protein_to_functions[tokens[1]] = set()
-            protein_to_functions[tokens[1]].add(tokens[3])
+def read_in_annotations(annotations):
+    """ Read in the file that contains the protein annotations (or take the
+        already loaded AnnotationIndex), and return protein to function
+        dictionary """
+    return annotation_index(annotations).protein_to_functions()
 
-    return protein_to_functions
+
+#-------------------------------------------------------------------------------
+
+def edge_arrays(graph):
+    """ Return the edges of the graph as two arrays of nodes, in the same order
+        as graph.edges_iter() """
+    E = np.array(graph.edges(), dtype = np.int64).reshape(-1, 2)
+    return E[:, 0], E[:, 1]
 
 
 #-------------------------------------------------------------------------------
 
-def all_functions(graph, id_to_protein, annotation_file, path):
+def all_functions(graph, id_to_protein, annotations, path):
     """ Finds all functions with which proteins in the graph are annotated with
-        and saves the list at the given path
+        and saves the list at the given path. annotations is the path of the
+        annotation file or its AnnotationIndex
     """
-    protein_to_functions = read_in_annotations(annotation_file)
-    functions = set()
-
-    for node in graph.nodes_iter():
-        p = id_to_protein[node]
-        p_f = protein_to_functions.get(p, set())
-        functions.update(p_f)
+    index = annotation_index(annotations)
+    M = index.matrix(graph.order(), id_to_protein)
+    used = np.unique(M.indices)
 
     with open(path, 'w') as out:
-        for f in functions:
-            out.write('%s\n' % f)
+        for f in used:
+            out.write('%s\n' % index.functions[f])
 
 
 #-------------------------------------------------------------------------------
@@ -133,23 +308,24 @@ def common_elements(set1, set2):
 
 #-------------------------------------------------------------------------------
 
-def function_to_function(graph, id_to_protein, annotation_file, path):
+def function_to_function(graph, id_to_protein, annotations, path):
     """ Build function-to-function edgelist for all functions pairs with which
         connected nodes in the graph are annotated. The edgelist is savet at
         the given path. This file is later used for Resnik sematic metric
-        calculation in R
+        calculation in R. annotations is the path of the annotation file or
+        its AnnotationIndex
     """
-    protein_to_functions = read_in_annotations(annotation_file)
+    index = annotation_index(annotations)
+    M = index.matrix(graph.order(), id_to_protein)
+    n1, n2 = edge_arrays(graph)
+    # (f1, f2) is nonzero if f1 and f2 annotate the two ends of some edge
+    C = M[n1].transpose().dot(M[n2]).tocoo()
+
     function_pairs = set()
-    for edge in graph.edges_iter():
-        n1 = id_to_protein[edge[0]]
-        n2 = id_to_protein[edge[1]]
-        set1 = protein_to_functions.get(n1, set())
-        set2 = protein_to_functions.get(n2, set())
-        for f1 in set1:
-            for f2 in set2:
-                pair = (min(f1, f2), max(f1, f2))
-                function_pairs.add(pair)
+    for i, j in itertools.izip(C.row, C.col):
+        f1 = index.functions[i]
+        f2 = index.functions[j]
+        function_pairs.add((min(f1, f2), max(f1, f2)))
 
     with open(path, 'w') as out:
         for pair in function_pairs:
@@ -180,14 +356,16 @@ def save_pageranks(graph, restart_prob, path, seed_node = None):
 
 def remove_zero_weights_from_edgelist (in_path, out_path):
     """ Read in graph output as edgelist in the in_path file and
-        write it back to out_path file with 0-weight edges removed
+        write it back to out_path file with 0-weight edges removed. An
+        edgelist without weights has no 0-weight edges and is copied as is
     """
-    with open(in_path, 'r') as in_file:
-        with open(out_path, 'w') as out_file:
-            for line in in_file:
-                tokens = line.split()
-                if int(tokens[2]) > 0 or int(tokens[2]) < 0:
-                    out_file.write(line)
+    with open(out_path, 'w') as out_file:
+        for nodes1, nodes2, weights, lines in iter_edgelist_chunks(in_path, with_lines = True):
+            if weights is None:
+                out_file.writelines(lines)
+                continue
+            for i in np.where(weights != 0)[0]:
+                out_file.write(lines[i])
 
 
 #-------------------------------------------------------------------------------
@@ -205,36 +383,205 @@ def remove_zero_weights_from_graph (graph):
 #------------------------------------------------------------------------------
 
 def pagerank(graph, alpha, start_node, max_iterations = 100, threshold = 1e-06):
-    # google matrix (row stochastic)
-    Q = set_transition_probabilities(graph, alpha, start_node)
-    Q = Q.transpose() # column stochastic
+    """ Personalized pagerank of start_node with restart probability alpha,
+        stopping after max_iterations or when the L1 residual is within
+        threshold (see personalized_pagerank) """
+    Q, dangling = transition_matrix(adjacency_matrix(graph))
+    return personalized_pagerank(Q, dangling, alpha, start_node, \
+                                 max_iterations, threshold, norm = 'l1')
 
-    p = np.zeros(graph.order())
-    p[start_node] = 1.0
-    it = max_iterations
 
-    while(it > 0):
-        it -= 1
-        #old_p = np.copy(p)
-        p = Q.dot(p)
-        #if np.linalg.norm(p - old_p) <= threshold: break
+#------------------------------------------------------------------------------
 
-    return p
+def adjacency_matrix(graph, weight = 'weight'):
+    """ Weighted adjacency matrix of the graph in CSR format. Nodes are expected
+        to be labeled 0..N-1, row i of the matrix holds the out-edges of node i
+    """
+    return nx.to_scipy_sparse_matrix(graph, nodelist = range(graph.order()), \
+                                     weight = weight, format = 'csr')
 
 
-#------------------------------------------------------------------------------
+#-------------------------------------------------------------------------------
+
+def transition_matrix(A):
+    """ Build the column stochastic transition matrix Q of the random walk over
+        the weighted adjacency matrix A (Q[j, i] = A[i, j] / sum(A[i, :])).
+        Returns Q in CSR format and the boolean mask of the dangling nodes
+        (nodes without outgoing weight). The matrix does not depend on the
+        restart probability nor on the seed node, so it is built once per graph
+    """
+    A = scipy.sparse.csr_matrix(A, dtype = np.float64)
+    weights_sum = np.asarray(A.sum(axis = 1)).ravel()
+    dangling = weights_sum == 0
+
+    scale = np.zeros(A.shape[0])
+    scale[~dangling] = 1.0 / weights_sum[~dangling]
+    Q = scipy.sparse.diags(scale).dot(A).transpose().tocsr()
+
+    return Q, dangling
 
-def multiply(G, p, old_p, start_node):
-    """ One iteration of the power method used for personalized pagerank calculation """
-    for i in xrange(len(p)):
-        p[i] = 0.0
 
-    for node1 in G.nodes_iter():
-        for node2 in G.predecessors_iter(node1):
-            p[node1] += (G[node2][node1]['transition']*old_p[node2])
+def save_transition_matrix(Q, dangling, path):
+    """ Save the transition matrix Q and the dangling nodes mask (as returned by
+        transition_matrix) as .npy files in the directory at the given path, so
+        that other processes can memory-map them with load_transition_matrix
+    """
+    save_csr_matrix(Q, path)
+    np.save(os.path.join(path, 'dangling.npy'), dangling)
+
+
+def load_transition_matrix(path, mmap_mode = 'r'):
+    """ Load the transition matrix saved with save_transition_matrix, memory-
+        mapped as in load_csr_matrix
+    """
+    dangling = np.load(os.path.join(path, 'dangling.npy'), mmap_mode = mmap_mode)
+    return load_csr_matrix(path, mmap_mode), dangling
 
-    if not p[start_node] > 0:
-        p[start_node] += (G[start_node][start_node]['transition']*old_p[start_node])
+
+#-------------------------------------------------------------------------------
+
+def personalized_pagerank(Q, dangling, alpha, start_node, max_iterations = 50, \
+                          threshold = 1e-04, p0 = None, norm = 'max'):
+    """ Personalized pagerank with restart probability alpha to start_node over
+        the transition matrix Q (as returned by transition_matrix). Dangling
+        nodes always jump back to start_node. The restart is applied as a rank-1
+        correction on the start_node entry, so the same Q is reused for every
+        seed. The power method stops after max_iterations or when no entry
+        changes by more than threshold. See personalized_pagerank_block for
+        the starting vector p0 and norm
+    """
+    if p0 is not None:
+        p0 = np.reshape(p0, (-1, 1))
+    return personalized_pagerank_block(Q, dangling, alpha, [start_node], \
+                                       max_iterations, threshold, p0, norm)[:, 0]
+
+
+#-------------------------------------------------------------------------------
+
+def personalized_pagerank_block(Q, dangling, alpha, start_nodes, \
+                                max_iterations = 50, threshold = 1e-04, \
+                                p0 = None, norm = 'max', return_iterations = False):
+    """ Personalized pageranks for a block of seeds at once. Column c of the
+        returned N x k matrix is the stationary distribution for start_nodes[c],
+        equal to what personalized_pagerank returns for that seed. Every step
+        is a single sparse-times-dense product over the columns that have not
+        converged yet, each column stops as soon as its own threshold is met.
+        p0 is the N x k matrix of the starting vectors (the indicator vectors
+        of the seeds by default), a warm start close to the solution saves
+        steps. norm is the measure of the change of a column compared with
+        threshold: 'max' (largest change of an entry) or 'l1' (the L1
+        residual). With return_iterations, (P, iterations) is returned where
+        iterations holds the number of steps of every seed
+    """
+    start_nodes = np.asarray(start_nodes, dtype = np.int64)
+    if norm not in ('max', 'l1'):
+        raise ValueError('Unknown norm %s' % norm)
+    # sparse row, so that every column is summed in the same order whatever
+    # the size of the block
+    restart = scipy.sparse.csr_matrix(np.where(dangling, 1.0, alpha))
+
+    it = max_iterations
+    if p0 is None:
+        P = np.zeros((Q.shape[0], len(start_nodes)))
+        P[start_nodes, np.arange(len(start_nodes))] = 1.0
+    else:
+        P = np.array(p0, dtype = np.float64).reshape(Q.shape[0], len(start_nodes))
+    active = np.arange(len(start_nodes))
+    iterations = np.zeros(len(start_nodes), dtype = np.int64)
+
+    while(it > 0 and len(active) > 0):
+        it -= 1
+        old_P = P[:, active]
+        new_P = (1 - alpha) * Q.dot(old_P)
+        new_P[start_nodes[active], np.arange(len(active))] += restart.dot(old_P)[0]
+        P[:, active] = new_P
+        iterations[active] += 1
+        change = np.absolute(new_P - old_P)
+        change = change.max(axis = 0) if norm == 'max' else change.sum(axis = 0)
+        active = active[change > threshold]
+
+    if return_iterations:
+        return P, iterations
+    return P
+
+
+def pagerank_block_size(nodes, memory_mb = 256):
+    """ Number of seeds that personalized_pagerank_block can process together
+        within roughly memory_mb megabytes (four dense float64 N x k arrays are
+        alive during one step)
+    """
+    return max(1, int(memory_mb * 2**20 / (4 * 8 * nodes)))
+
+
+def iter_pagerank_blocks(Q, dangling, alpha, start_nodes, max_iterations = 50, \
+                         threshold = 1e-04, memory_mb = 256):
+    """ Split start_nodes in blocks that fit in memory_mb and yield
+        (block_nodes, P) pairs where P holds the pageranks of the block's seeds
+        as columns
+    """
+    start_nodes = np.asarray(start_nodes, dtype = np.int64)
+    step = pagerank_block_size(Q.shape[0], memory_mb)
+
+    for i in xrange(0, len(start_nodes), step):
+        block = start_nodes[i : i + step]
+        yield block, personalized_pagerank_block(Q, dangling, alpha, block, \
+                                                 max_iterations, threshold)
+
+
+def neighbour_warm_start(A, alpha, start_nodes, solved_nodes, solved_P):
+    """ Starting vectors for personalized_pagerank_block built from the
+        pageranks solved_P (columns) of the seeds solved_nodes. A seed s with
+        solved neighbours t gets alpha e_s + (1 - alpha) sum_t w_st p_t, with
+        w_st the weights of its edges to them normalized to sum 1 (the
+        decomposition of a pagerank over the ones of the neighbours),
+        the other seeds get their indicator vector
+    """
+    start_nodes = np.asarray(start_nodes, dtype = np.int64)
+    W = scipy.sparse.csr_matrix(A)[start_nodes][:, np.asarray(solved_nodes)]
+    sums = np.asarray(W.sum(axis = 1)).ravel()
+    found = sums > 0
+
+    P0 = np.zeros((A.shape[0], len(start_nodes)))
+    if found.any():
+        W = scipy.sparse.diags(1.0 / sums[found]).dot(W[np.where(found)[0]])
+        P0[:, found] = (1 - alpha) * W.dot(solved_P.T).T
+    columns = np.arange(len(start_nodes))
+    P0[start_nodes, columns] += np.where(found, alpha, 1.0)
+    return P0
+
+
+def pagerank_sweep(A, alphas, start_nodes, max_iterations = 50, threshold = 1e-04, \
+                   memory_mb = 256, norm = 'l1', warm_start = True):
+    """ Personalized pageranks of all start_nodes for every restart probability
+        in alphas over the weighted adjacency matrix A. Seeds are solved in
+        blocks (as in iter_pagerank_blocks) and yielded as (alpha, block_nodes,
+        P, iterations) with iterations the number of steps of every seed. With
+        warm_start, the first restart probability of a block starts from the
+        pageranks of the previous block (see neighbour_warm_start) and every
+        other one from the solution of the previous restart probability for
+        the same seeds. See personalized_pagerank_block for norm
+    """
+    Q, dangling = transition_matrix(A)
+    start_nodes = np.asarray(start_nodes, dtype = np.int64)
+    # the previous block and the previous solution are kept as well
+    step = max(1, pagerank_block_size(Q.shape[0], memory_mb) // 2)
+    previous = None
+
+    for i in xrange(0, len(start_nodes), step):
+        block = start_nodes[i : i + step]
+        P = None
+        for k, alpha in enumerate(alphas):
+            p0 = None
+            if warm_start and k > 0:
+                p0 = P
+            elif warm_start and previous is not None:
+                p0 = neighbour_warm_start(A, alpha, block, previous[0], previous[1])
+            P, iterations = personalized_pagerank_block(Q, dangling, alpha, block, \
+                                                        max_iterations, threshold, \
+                                                        p0, norm, True)
+            if k == 0:
+                previous = (block, P)
+            yield alpha, block, P, iterations
 
 
 #-------------------------------------------------------------------------------
@@ -268,27 +615,114 @@ def set_transition_probabilities(graph, damping, start_node):
 
 #-------------------------------------------------------------------------------
 
-def pagerank2(graph, alpha, start_node, max_iterations = 50, threshold = 1e-04):
-    """ Personalized pagerank implementation """
-    for_removal = set_transition_probabilities(graph, alpha, start_node)
-
-    it = max_iterations
-    p = np.zeros(graph.order())
-    p[start_node] = 1.0
-    old_p = np.zeros(graph.order())
-
-    while(it > 0):
-        it -= 1
-        for i in xrange(len(p)):
-            old_p[i] = p[i]
-
-        multiply(graph, p, old_p, start_node)
-        if max(np.absolute(p - old_p)) <= threshold: break
-
-    for e in for_removal:
-        graph.remove_edge(e[0], e[1])
-
-    return p
+def pagerank2(graph, alpha, start_node, max_iterations = 50, threshold = 1e-04, \
+              p0 = None, norm = 'max'):
+    """ Personalized pagerank implementation. p0 is the starting vector (see
+        personalized_pagerank_block) """
+    Q, dangling = transition_matrix(adjacency_matrix(graph))
+    return personalized_pagerank(Q, dangling, alpha, start_node, \
+                                 max_iterations, threshold, p0, norm)
+
+
+def csr_row_entries(A, rows):
+    """ Positions in A.indices and A.data of all the entries of the given rows
+        of the CSR matrix A, row after row, and the number of entries of
+        every row """
+    starts = A.indptr[rows]
+    counts = A.indptr[rows + 1] - starts
+    if len(rows) == 1:
+        return np.arange(starts[0], starts[0] + counts[0]), counts
+    entries = np.repeat(starts - np.cumsum(counts) + counts, counts) + \
+              np.arange(counts.sum())
+    return entries, counts
+
+
+def local_push_pagerank(A, alpha, start_node, eps = 1e-04, degrees = None):
+    """ Approximate personalized pagerank of start_node with restart
+        probability alpha by local push (Andersen, Chung and Lang), over the
+        weighted adjacency matrix A in CSR format (see adjacency_matrix).
+        Dangling nodes send their mass back to start_node, as in
+        personalized_pagerank. Residual mass is pushed from a node only while
+        it is at least eps times its weighted degree; all such nodes are
+        pushed together in every round. The result underestimates the exact
+        pagerank by at most eps * d_v at every node v of degree d_v of an
+        undirected graph, and the total missing mass is the residual left.
+        Only the nodes reached by the push are kept, in arrays sorted by node,
+        so the cost depends on that neighbourhood and not on the size of the
+        graph. degrees are the weighted degrees of all the nodes (row sums of
+        A), pass them when the same graph is queried many times, otherwise
+        they are summed for the reached nodes only. Returns the 1 x N sparse
+        vector in CSR format
+    """
+    def row_degrees(rows):
+        if degrees is not None:
+            return degrees[rows]
+        entries, counts = csr_row_entries(A, rows)
+        return np.bincount(np.repeat(np.arange(len(rows)), counts), \
+                           weights = A.data[entries], minlength = len(rows))
+
+    # pagerank, residual, degree and push limit of the reached nodes
+    nodes = np.array([start_node], dtype = np.int64)
+    p = np.zeros(1)
+    r = np.ones(1)
+    d = row_degrees(nodes)
+    limits = eps * np.where(d > 0, d, 1.0)
+    active = np.zeros(1, dtype = np.int64)
+
+    while len(active):
+        mass = r[active]
+        p[active] += alpha * mass
+        r[active] = 0.0
+        mass *= (1 - alpha)
+
+        entries, counts = csr_row_entries(A, nodes[active])
+        share = mass / np.where(d[active] > 0, d[active], 1.0)
+        targets = A.indices[entries]
+        pushed = A.data[entries] * np.repeat(share, counts)
+
+        # dangling nodes send their mass to the seed
+        dangling = mass[d[active] <= 0].sum()
+        if dangling > 0:
+            targets = np.append(targets, start_node)
+            pushed = np.append(pushed, dangling)
+
+        targets, inverse = np.unique(targets, return_inverse = True)
+        pushed = np.bincount(inverse, weights = pushed)
+
+        # nodes reached for the first time
+        positions = np.searchsorted(nodes, targets)
+        new = positions == len(nodes)
+        new[~new] = nodes[positions[~new]] != targets[~new]
+        if new.any():
+            at = positions[new]
+            new_degrees = row_degrees(targets[new])
+            nodes = np.insert(nodes, at, targets[new])
+            p = np.insert(p, at, 0.0)
+            r = np.insert(r, at, 0.0)
+            d = np.insert(d, at, new_degrees)
+            limits = np.insert(limits, at, eps * np.where(new_degrees > 0, new_degrees, 1.0))
+            positions = np.searchsorted(nodes, targets)
+
+        r[positions] += pushed
+        active = positions[r[positions] >= limits[positions]]
+
+    keep = p > 0
+    return scipy.sparse.csr_matrix((p[keep], nodes[keep], [0, keep.sum()]), \
+                                   shape = (1, A.shape[0]))
+
+
+def pagerank_push(graph, alpha, start_nodes, eps = 1e-04):
+    """ Approximate personalized pageranks of the start_nodes (a node or a
+        list of nodes) by local push (see local_push_pagerank). The adjacency
+        matrix and the degrees are built once for all of them. Returns the
+        len(start_nodes) x N sparse matrix in CSR format, row k is the
+        pagerank of start_nodes[k]
+    """
+    A = adjacency_matrix(graph)
+    degrees = np.asarray(A.sum(axis = 1)).ravel()
+    return scipy.sparse.vstack([local_push_pagerank(A, alpha, s, eps, degrees) \
+                                for s in np.atleast_1d(start_nodes).tolist()], \
+                               format = 'csr')
 
 
 #-------------------------------------------------------------------------------
@@ -298,12 +732,12 @@ def filter_unexisting_edges (graph, edgelist_path, path):
         Save the new edgelist graph at the given path
     """
     print 'Filtering', edgelist_path
-    with open (edgelist_path, 'r') as in_file:
-        with open (path, 'w') as out_file:
-            for line in in_file:
-                tokens = line.split()
-                if graph.has_edge(int(tokens[0]), int(tokens[1])):
-                    out_file.write(line)
+    keys = edge_keys(graph.edges(), graph.is_directed())
+    with open (path, 'w') as out_file:
+        for chunk in iter_edgelist_chunks(edgelist_path, with_lines = True):
+            nodes1, nodes2, lines = chunk[0], chunk[1], chunk[3]
+            for i in np.where(has_edges(keys, nodes1, nodes2))[0]:
+                out_file.write(lines[i])
 
 
 #-------------------------------------------------------------------------------
@@ -1,7 +1,14 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 
+import itertools
+import os
 import networkx as nx
+import numpy as np
+import scipy.sparse
+from annotation_index import file_hash
+from edgelist_io import *
+from proximity_store import read_sparse_proximities
 
 
 #-------------------------------------------------------------------------------
@@ -48,18 +55,194 @@ def build_graph_from_edgelist(path, nodes = None):
     if nodes:
         G.add_nodes_from(range(nodes))
 
-    with open(path, 'r') as in_file:
-        for line in in_file:
-            tokens = line.split()
-            node1 = int(tokens[0])
-            node2 = int(tokens[1])
-            if len(tokens) > 2:
-                w = float(tokens[2])
-                if w > 0.0 or w < 0.0:
-                    G.add_edge(node1, node2)
-                    G[node1][node2]['weight'] = w
-            else:
-                G.add_edge(node1, node2)
+    for nodes1, nodes2, weights in iter_edgelist_chunks(path):
+        if weights is not None:
+            nonzero = weights != 0
+            G.add_weighted_edges_from(itertools.izip(nodes1[nonzero].tolist(), \
+                                                     nodes2[nonzero].tolist(), \
+                                                     weights[nonzero].tolist()))
+        else:
+            G.add_edges_from(itertools.izip(nodes1.tolist(), nodes2.tolist()))
+
+    return G
+
 
+
+def build_graph_from_proximities(path):
+    """ Build the graph of the sparse proximities saved by
+        random_walk_save_sparse, w{n1, n2} = (p_n1[n2] + p_n2[n1]) / 2 over
+        the kept entries, without self loops """
+    M = read_sparse_proximities(path)[0]
+    W = ((M + M.transpose()) * 0.5).tocoo()
+    upper = W.row < W.col
+
+    G = nx.Graph()
+    G.add_nodes_from(xrange(M.shape[0]))
+    G.add_weighted_edges_from(itertools.izip(W.row[upper].tolist(), \
+                                             W.col[upper].tolist(), \
+                                             W.data[upper].tolist()))
     return G
 
+
+#-------------------------------------------------------------------------------
+
+class CachedGraph(object):
+    """ Undirected graph loaded from the binary cache written by
+        save_graph_cache: the adjacency in CSR arrays (indptr, indices and
+        weights, which is None for unweighted graphs) over nodes 0..N-1, the
+        labels of the nodes that are actually in the graph and the
+        id_to_protein table. The networkx graph is built only when the graph
+        attribute is used for the first time
+    """
+
+    def __init__(self, nodes, indptr, indices, weights = None, id_to_protein = None):
+        self.nodes = nodes
+        self.indptr = indptr
+        self.indices = indices
+        self.weights = weights
+        self.id_to_protein = id_to_protein
+        self._graph = None
+
+
+    def order(self):
+        """ Number of nodes in the graph """
+        return len(self.nodes)
+
+
+    def adjacency(self):
+        """ Adjacency matrix in CSR format (1 for every edge of unweighted
+            graphs) """
+        N = len(self.indptr) - 1
+        data = self.weights if self.weights is not None else np.ones(len(self.indices))
+        return scipy.sparse.csr_matrix((data, self.indices, self.indptr), \
+                                       shape = (N, N), copy = False)
+
+
+    @property
+    def graph(self):
+        """ The networkx graph, built on first use """
+        if self._graph is None:
+            G = nx.Graph()
+            G.add_nodes_from(self.nodes.tolist())
+            rows = np.repeat(np.arange(len(self.indptr) - 1), np.diff(self.indptr))
+            upper = rows <= self.indices
+            if self.weights is not None:
+                G.add_weighted_edges_from(itertools.izip(rows[upper].tolist(), \
+                                                         self.indices[upper].tolist(), \
+                                                         self.weights[upper].tolist()))
+            else:
+                G.add_edges_from(itertools.izip(rows[upper].tolist(), \
+                                                self.indices[upper].tolist()))
+            self._graph = G
+        return self._graph
+
+
+#-------------------------------------------------------------------------------
+
+def save_graph_cache (graph, path, id_to_protein = None, source = None):
+    """ Save the undirected graph (nodes are ints) and the id_to_protein table
+        as .npy files in the directory at the given path. If source is given,
+        the modification time and the hash of that file are stored, so that
+        the cache can be checked against it
+    """
+    if not os.path.isdir(path):
+        os.makedirs(path)
+
+    nodes = np.array(sorted(graph.nodes()), dtype = np.int64)
+    N = nodes[-1] + 1 if len(nodes) else 0
+    edges = graph.edges(data = True)
+    u = np.array([e[0] for e in edges], dtype = np.int64)
+    v = np.array([e[1] for e in edges], dtype = np.int64)
+    weighted = len(edges) > 0 and all('weight' in e[2] for e in edges)
+    w = np.array([e[2]['weight'] if weighted else 1.0 for e in edges])
+
+    # both directions of every edge, self loops only once
+    loops = u == v
+    A = scipy.sparse.coo_matrix((np.concatenate((w, w[~loops])), \
+                                 (np.concatenate((u, v[~loops])), \
+                                  np.concatenate((v, u[~loops])))), \
+                                shape = (N, N)).tocsr()
+    A.sort_indices()
+
+    np.save(os.path.join(path, 'nodes.npy'), nodes)
+    np.save(os.path.join(path, 'indptr.npy'), A.indptr)
+    np.save(os.path.join(path, 'indices.npy'), A.indices)
+    if weighted:
+        np.save(os.path.join(path, 'weights.npy'), A.data)
+    elif os.path.exists(os.path.join(path, 'weights.npy')):
+        os.remove(os.path.join(path, 'weights.npy'))
+    if id_to_protein is not None:
+        proteins = [id_to_protein.get(i, '') for i in xrange(N)]
+        np.save(os.path.join(path, 'proteins.npy'), np.array(proteins, dtype = str))
+    if source is not None:
+        save_source_stamp(path, source)
+
+
+def save_source_stamp (path, source, digest = None):
+    """ Stamp the cache at the given path with the modification time and the
+        hash (digest, if it is already known) of the source file """
+    if digest is None:
+        digest = file_hash(source)
+    np.save(os.path.join(path, 'source.npy'), \
+            np.array([str(os.path.getmtime(source)), digest]))
+
+
+def load_graph_cache (path, mmap_mode = 'r'):
+    """ Load the graph saved with save_graph_cache as CachedGraph, the arrays
+        are memory-mapped """
+    def load(name):
+        if os.path.exists(os.path.join(path, name)):
+            return np.load(os.path.join(path, name), mmap_mode = mmap_mode)
+        return None
+
+    proteins = load('proteins.npy')
+    id_to_protein = None
+    if proteins is not None:
+        id_to_protein = dict((i, p) for i, p in enumerate(proteins.tolist()) if p)
+
+    return CachedGraph(np.asarray(load('nodes.npy')), load('indptr.npy'), \
+                       load('indices.npy'), load('weights.npy'), id_to_protein)
+
+
+def graph_cache_is_valid (path, source):
+    """ Check whether the cache at the given path was written from the current
+        content of the source file. A cache whose hash still matches is
+        stamped with the new modification time, so the file is hashed only
+        once after it was touched """
+    if not os.path.exists(os.path.join(path, 'source.npy')):
+        return False
+    mtime, digest = np.load(os.path.join(path, 'source.npy')).tolist()
+    if mtime == str(os.path.getmtime(source)):
+        return True
+    if digest == file_hash(source):
+        save_source_stamp(path, source, digest)
+        return True
+    return False
+
+
+#-------------------------------------------------------------------------------
+
+def build_graph_cached (path, cache_path = None):
+    """ build_graph through the binary cache at cache_path (path + '.graph' by
+        default), which is written on the first call and whenever the data file
+        changes. Returns CachedGraph, its graph attribute is the networkx graph
+        and its id_to_protein attribute the same dictionary build_graph returns
+    """
+    if cache_path is None:
+        cache_path = '%s.graph' % path
+    if not graph_cache_is_valid(cache_path, path):
+        G, id_to_protein = build_graph(path)
+        save_graph_cache(G, cache_path, id_to_protein, path)
+    return load_graph_cache(cache_path)
+
+
+def build_graph_from_edgelist_cached (path, nodes = None, cache_path = None):
+    """ build_graph_from_edgelist through the binary cache at cache_path
+        (path + '.graph' by default). Returns CachedGraph """
+    if cache_path is None:
+        cache_path = '%s.graph' % path
+    if not graph_cache_is_valid(cache_path, path) or \
+            (nodes and load_graph_cache(cache_path).order() != nodes):
+        G = build_graph_from_edgelist(path, nodes)
+        save_graph_cache(G, cache_path, None, path)
+    return load_graph_cache(cache_path)
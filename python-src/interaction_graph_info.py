@@ -2,8 +2,10 @@
 # -*- coding: utf-8 -*-
 
 import networkx as nx
+import numpy as np
 import matplotlib.pyplot as plt
 from graph_utility import *
+from distance_store import *
 
 
 #-------------------------------------------------------------------------------
@@ -72,22 +74,17 @@ def plot_clustering_spectrum (graph, path):
 def plot_shortest_path_spectrum (graph, path, paths_data):
     """Plot distribution of shortest paths of the graph and save the figure
        at the given path. On X-axis we have distance values and on Y-axis we
-       have percentage of node pairs that have that distance value"""
+       have percentage of node pairs that have that distance value.
+       paths_data is the distance store written by save_all_shortest_paths"""
 
-    diameter = graph_diameter(paths_data)
     pairs = graph.order() * (graph.order()-1) * 0.5
 
-    distances_count = [0 for i in xrange(diameter + 1)]
-    for i in xrange(8):
-        with open('%s_%d' % (paths_data, i), 'r') as in_file:
-            for line in in_file:
-                tokens = line.split()
-                distances_count[int(tokens[2])] += 1
+    distances_count = distance_histogram(paths_data).astype(np.float64)
+    # pairs without a path are counted at 0
+    distances_count[0] = 0
+    distances_count *= (100.0 / pairs)
 
-    for i in xrange(diameter + 1):
-        distances_count[i] *= (100.0 / pairs)
-
-    y = distances_count
+    y = distances_count.tolist()
     plt.loglog(y, 'b-', marker = '.')
     plt.title("Shortest Paths Spectrum")
     plt.ylabel("Percent of pairs")
@@ -165,32 +162,25 @@ def plot_proteins_sharing_function(id_to_protein, \
        that have at least one common function.
        id_to_protein: dictionary where each node in the graph maps to a protein
        annotation_file: path to the file that cointains proteins and their functions
-       distance_file: path to the file that contains shortest paths between the nodes"""
+                        (or its AnnotationIndex)
+       distance_file: the distance store written by save_all_shortest_paths"""
 
-    protein_to_functions = read_in_annotations(annotation_file)
+    nodes, diameter = read_distance_header(distance_file)
+    M = annotation_index(annotation_file).matrix(nodes, id_to_protein)
+
+    distance_to_count = np.zeros(diameter + 1)
+    distance_to_common = np.zeros(diameter + 1)
+    for nodes1, nodes2, d in iter_distance_blocks(distance_file, 1 << 20):
+        common = np.asarray(M[nodes1].multiply(M[nodes2]).sum(axis = 1)).ravel() > 0
+        distance_to_count += np.bincount(d, minlength = diameter + 1)
+        distance_to_common += np.bincount(d[common], minlength = diameter + 1)
 
-    distance_to_count = {}
-    distance_to_common = {}
-    for i in xrange(8):
-        with open('%s_%d' % (distance_file, i), 'r') as in_file:
-            for line in in_file:
-                tokens = line.split()
-                p1 = id_to_protein[int(tokens[0])]
-                p2 = id_to_protein[int(tokens[1])]
-                d = int(tokens[2])
-                distance_to_count[d] = 1 + distance_to_count.get(d, 0)
-                if p1 in protein_to_functions and \
-                        p2 in protein_to_functions and \
-                        common_elements(protein_to_functions[p1], protein_to_functions[p2]):
-                    distance_to_common[d] = 1 + distance_to_common.get(d, 0)
-
-    for d in distance_to_common:
-        distance_to_common[d] *= (100.0 / distance_to_count[d])
+    found = distance_to_count > 0
+    distance_to_common[found] *= (100.0 / distance_to_count[found])
 
     # Plotting
-    diameter = graph_diameter(distance_file)
     x = range(0, diameter + 1)
-    y = [distance_to_common.get(i, 0) for i in x]
+    y = distance_to_common.tolist()
 
     plt.bar(x, y, width = 1, color = 'b')
     plt.title("Proteins sharing common functions\n depending on the distance between them")
@@ -244,4 +234,21 @@ def plot_function_first_appearance(id_to_protein, annotation_file, \
     plt.ylabel("Normalized number of functions")
     plt.xlabel("Distance")
     plt.axis('tight')
-    plt.savefig(path)
\ No newline at end of file
+    plt.savefig(path)
+
+
+#-------------------------------------------------------------------------------
+
+def plot_precision_recall (results, path):
+    """ Plot the precision/recall curves of the function prediction of several
+        graphs, as compare_predictions returns them, in one figure and save it
+        at the given path. On X-axis we have recall and on Y-axis precision """
+    for name in sorted(results):
+        plt.plot(results[name]['recall'], results[name]['precision'], '-', \
+                 label = '%s (AUPR %.3f)' % (name, results[name]['aupr']))
+    plt.title("Function prediction from clusters")
+    plt.ylabel("Precision")
+    plt.xlabel("Recall")
+    plt.legend(loc = 'upper right')
+    plt.axis([0, 1, 0, 1])
+    plt.savefig(path)
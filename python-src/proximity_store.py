@@ -0,0 +1,193 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import os
+import struct
+import numpy as np
+import scipy.sparse
+
+
+# Binary store of personalized pageranks (random walk proximities). The file
+# starts with a 16 bytes header ('PRXM', format version, number of nodes N)
+# and continues with one record per seed node: the seed as int32 followed by
+# its N pageranks as float32. Records can be appended in any order.
+PROXIMITY_MAGIC = 'PRXM'
+PROXIMITY_VERSION = 1
+PROXIMITY_HEADER = struct.Struct('<4sIQ')
+
+# Sparse proximities keep only some of the pageranks of every seed, as the
+# N x N CSR matrix whose row n1 holds the kept entries p_n1[n2], saved in a
+# .npz file together with the seeds that were calculated
+SPARSE_FORMAT = 'sparse_proximities_1'
+
+
+#-------------------------------------------------------------------------------
+
+def proximity_record_dtype(nodes):
+    """ numpy dtype of a single record of the store of a graph with the given
+        number of nodes """
+    return np.dtype([('seed', '<i4'), ('p', '<f4', (nodes,))])
+
+
+def is_proximity_store(path):
+    """ Check whether the file at the given path is a binary proximity store """
+    with open(path, 'rb') as in_file:
+        return in_file.read(len(PROXIMITY_MAGIC)) == PROXIMITY_MAGIC
+
+
+def proximity_store_nodes(path):
+    """ Read the number of nodes from the header of the store """
+    with open(path, 'rb') as in_file:
+        header = in_file.read(PROXIMITY_HEADER.size)
+        magic, version, nodes = PROXIMITY_HEADER.unpack(header)
+    if magic != PROXIMITY_MAGIC or version != PROXIMITY_VERSION:
+        raise ValueError('%s is not a proximity store' % path)
+    return nodes
+
+
+#-------------------------------------------------------------------------------
+
+def create_proximity_store(path, nodes):
+    """ Create an empty store for a graph with the given number of nodes """
+    with open(path, 'wb') as out:
+        out.write(PROXIMITY_HEADER.pack(PROXIMITY_MAGIC, PROXIMITY_VERSION, nodes))
+
+
+def append_proximity_rows(path, seeds, P):
+    """ Append the pageranks of the seed nodes, given as columns of the N x k
+        matrix P, to the store at the given path (created if missing) """
+    N = P.shape[0]
+    if not os.path.exists(path):
+        create_proximity_store(path, N)
+    elif proximity_store_nodes(path) != N:
+        raise ValueError('%s stores pageranks of a graph with different order' % path)
+
+    records = np.empty(len(seeds), dtype = proximity_record_dtype(N))
+    records['seed'] = seeds
+    records['p'] = P.T
+    with open(path, 'ab') as out:
+        records.tofile(out)
+
+
+def merge_proximity_stores(path, shard_paths):
+    """ Append the records of all the stores in shard_paths, in the given order,
+        to the store at the given path """
+    for shard in shard_paths:
+        N = proximity_store_nodes(shard)
+        if not os.path.exists(path):
+            create_proximity_store(path, N)
+        elif proximity_store_nodes(path) != N:
+            raise ValueError('%s and %s have different order' % (path, shard))
+
+        with open(shard, 'rb') as in_file:
+            in_file.seek(PROXIMITY_HEADER.size)
+            with open(path, 'ab') as out:
+                while True:
+                    buf = in_file.read(1 << 24)
+                    if not buf:
+                        break
+                    out.write(buf)
+
+
+#-------------------------------------------------------------------------------
+
+def read_proximity_store(path):
+    """ Memory-map the store at the given path. Returns (rows, P) where P is
+        the R x N float32 matrix of the stored pageranks and rows maps every
+        node to its row in P (-1 for nodes that were not used as seeds), so
+        p_n1[n2] is P[rows[n1], n2]
+    """
+    N = proximity_store_nodes(path)
+    records = np.memmap(path, dtype = proximity_record_dtype(N), mode = 'r', \
+                        offset = PROXIMITY_HEADER.size)
+
+    rows = np.empty(N, dtype = np.int64)
+    rows.fill(-1)
+    # if a seed is stored more than once its last record is used
+    rows[records['seed']] = np.arange(len(records))
+
+    return rows, records['p']
+
+
+def gather_proximities(rows, P, nodes1, nodes2):
+    """ Vectorized p_n1[n2] for all the pairs in (nodes1, nodes2) arrays, the
+        pairs where n1 is not stored get NaN """
+    r = rows[nodes1]
+    found = r >= 0
+    p = np.empty(len(r))
+    p.fill(np.nan)
+    p[found] = P[r[found], np.asarray(nodes2)[found]]
+    return p
+
+
+#-------------------------------------------------------------------------------
+
+def select_proximities(P, top_k = None, epsilon = None):
+    """ Select the entries of the pageranks (columns of the N x k matrix P)
+        to keep: the top_k largest of every column, found with a partial
+        selection, and/or the ones above epsilon. Returns the (nodes, columns)
+        index arrays of the selected entries
+    """
+    N, k = P.shape
+    if top_k is not None and top_k < N:
+        nodes = np.argpartition(-P, top_k - 1, axis = 0)[:top_k]
+        columns = np.tile(np.arange(k), top_k)
+        nodes = nodes.ravel()
+    else:
+        nodes = np.repeat(np.arange(N), k)
+        columns = np.tile(np.arange(k), N)
+
+    if epsilon is not None:
+        above = P[nodes, columns] > epsilon
+        nodes, columns = nodes[above], columns[above]
+    return nodes, columns
+
+
+def save_sparse_proximities(path, M, seeds):
+    """ Save the N x N sparse matrix M of the kept proximities (row n1 holds
+        p_n1[n2]) and the array of the seeds that were calculated """
+    M = scipy.sparse.csr_matrix(M, dtype = np.float32)
+    M.sort_indices()
+    with open(path, 'wb') as out:
+        np.savez(out, format = SPARSE_FORMAT, data = M.data, indices = M.indices, \
+                 indptr = M.indptr, seeds = np.asarray(seeds, dtype = np.int64))
+
+
+def is_sparse_proximities(path):
+    """ Check whether the file at the given path was written by
+        save_sparse_proximities """
+    if not os.path.isfile(path):
+        return False
+    with open(path, 'rb') as in_file:
+        if in_file.read(2) != 'PK':
+            return False
+    try:
+        with np.load(path) as data:
+            return str(data['format']) == SPARSE_FORMAT
+    except (IOError, KeyError, ValueError):
+        return False
+
+
+def read_sparse_proximities(path):
+    """ Load the sparse proximities saved at the given path. Returns (M, seeds)
+        where M is the N x N CSR matrix of the kept p_n1[n2] (the entries that
+        were not kept are 0) and seeds the boolean mask of the calculated
+        seeds """
+    with np.load(path) as data:
+        indptr = data['indptr']
+        N = len(indptr) - 1
+        M = scipy.sparse.csr_matrix((data['data'], data['indices'], indptr), \
+                                    shape = (N, N))
+        seeds = np.zeros(N, dtype = bool)
+        seeds[data['seeds']] = True
+    return M, seeds
+
+
+def gather_sparse_proximities(M, seeds, nodes1, nodes2):
+    """ gather_proximities over sparse proximities: p_n1[n2] for all the pairs
+        in (nodes1, nodes2) arrays, 0 for the entries that were not kept and
+        NaN where n1 was not calculated """
+    p = np.asarray(M[nodes1, nodes2], dtype = np.float64).ravel() \
+        if len(nodes1) else np.zeros(0)
+    p[~seeds[nodes1]] = np.nan
+    return p